@@ -1,46 +1,97 @@
 import csv
-import json
+import heapq
+import math
+import os
+import tempfile
 from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime
+from itertools import chain, groupby
 from pathlib import Path
-from typing import Dict, List, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import fast_json
+from compactor_retention import list_periods, period_bounds
+from sampling import ht_terms, inclusion_probability
+from site_shard import device_label, split_device_stem
+
+# 外部排序：每個彙總項目估計佔用的記憶體（tuple key、list 與 dict 的額外成本）
+ESTIMATED_ENTRY_BYTES = 512
+MIN_BUDGET_ENTRIES = 1000
+# 同時合併的 run 檔數量上限
+MAX_MERGE_FANIN = 64
 
 
 class DNSLogAnalyzer:
-    def __init__(self, start_date: str, end_date: str):
-        """初始化 DNS 日誌分析器"""
+    def __init__(self, start_date: str, end_date: str,
+                 memory_budget_mb: Optional[float] = None, spill_dir: Optional[str] = None):
+        """初始化 DNS 日誌分析器
+
+        抽樣機率讀取自每個收集檔案的 metadata。依日期抽樣的資料每列加上估計次數與
+        標準誤差；依設備抽樣時只提供網域層級的估計（write_domain_estimates）。
+        設定 memory_budget_mb 時，analyze_to_csv 超過預算會將部分彙總寫入 spill_dir
+        （預設為系統暫存目錄）的排序 run 檔，再以 k-way merge 產生最終 CSV。
+        """
         self.elastic_base_path = Path("elastic_query_results")
         self.dns_base_path = Path("dns_query_results")
         self.start_date = datetime.strptime(start_date, "%Y-%m-%d")
         self.end_date = datetime.strptime(end_date, "%Y-%m-%d")
+        self.elastic_periods = {}
+        self.dns_periods = {}
+        self.effective_range = (self.start_date.date(), self.end_date.date())
+        self.sample_units: Set[str] = set()
+        self.domain_units: Dict[Tuple, int] = defaultdict(int)
+        self.domain_exact: Dict[str, int] = defaultdict(int)
+        self.memory_budget_mb = memory_budget_mb
+        self.spill_dir = spill_dir
 
     def get_date_range(self) -> List[str]:
-        """生成指定日期範圍內的所有日期"""
+        """生成指定日期範圍內的所有日期，已彙總的舊資料以 start..end 期間標籤表示
+
+        彙總資料無法拆回單日，與查詢範圍部分重疊的期間整段納入，
+        實際涵蓋的範圍記錄於 effective_range。
+        """
+        self.elastic_periods = list_periods(str(self.elastic_base_path))
+        self.dns_periods = list_periods(str(self.dns_base_path))
+
         date_list = []
-        current_date = self.start_date
-        while current_date <= self.end_date:
-            date_str = current_date.strftime("%Y-%m-%d")
-            if (
-                (self.elastic_base_path / date_str).exists() and
-                (self.dns_base_path / date_str).exists()
-            ):
-                date_list.append(date_str)
-            current_date += timedelta(days=1)
+        effective_start, effective_end = self.start_date.date(), self.end_date.date()
+        for label in sorted(self.elastic_periods.keys() & self.dns_periods.keys()):
+            period_start, period_end = period_bounds(label)
+            if period_start <= self.end_date.date() and period_end >= self.start_date.date():
+                date_list.append(label)
+                effective_start = min(effective_start, period_start)
+                effective_end = max(effective_end, period_end)
+
+        self.effective_range = (effective_start, effective_end)
+        if self.effective_range != (self.start_date.date(), self.end_date.date()):
+            print(f"注意：查詢範圍與已彙總的期間部分重疊，"
+                  f"分析範圍擴大為 {effective_start} 至 {effective_end}")
         return date_list
 
+    def output_filename(self, prefix: str) -> str:
+        """以實際涵蓋的範圍命名輸出檔，避免彙總期間擴大範圍後與檔名不符"""
+        self.get_date_range()
+        effective_start, effective_end = self.effective_range
+        return f"{prefix}_{effective_start}_to_{effective_end}.csv"
+
+    def get_period_path(self, base_path: Path, date: str) -> Path:
+        """取得每日或彙總期間標籤對應的目錄"""
+        periods = self.elastic_periods if base_path == self.elastic_base_path else self.dns_periods
+        return Path(periods[date]) if date in periods else base_path / date
+
     def load_json_file(self, file_path: Path) -> Dict:
         """載入並解析JSON文件"""
         try:
             with open(file_path, 'r') as f:
-                return json.load(f)
+                return fast_json.load(f)
         except Exception as e:
             print(f"Error loading {file_path}: {str(e)}")
             return None
 
     def get_available_ips(self, date: str) -> List[str]:
-        """獲取指定日期下所有可用的IP"""
-        elastic_ips = set(f.stem for f in (self.elastic_base_path / date).glob("*.json"))
-        dns_files = (self.dns_base_path / date).glob("*.json")
+        """獲取指定日期下所有可用的設備檔名（多站點合併後為 <site>__<ip>）"""
+        elastic_ips = set(f.stem for f in self.get_period_path(self.elastic_base_path, date).glob("*.json"))
+        dns_files = self.get_period_path(self.dns_base_path, date).glob("*.json")
         dns_ips = set(f.stem for f in dns_files if not f.stem.startswith("dns_queries_"))
         return sorted(elastic_ips & dns_ips)
 
@@ -66,11 +117,23 @@ class DNSLogAnalyzer:
                     dns_mappings[dst_ip].add((question_name, answer_ip))
         return dns_mappings
 
+    def load_device_files(self, date: str, ip: str) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """載入單一設備的流量與 DNS 檔案"""
+        elastic_data = self.load_json_file(
+            self.get_period_path(self.elastic_base_path, date) / f"{ip}.json")
+        dns_data = self.load_json_file(self.get_period_path(self.dns_base_path, date) / f"{ip}.json")
+        return elastic_data, dns_data
+
     def analyze_device(self, date: str, ip: str) -> List[Dict]:
         """分析單一設備的數據，包含所有DNS答案"""
+        return self.device_results(date, ip, *self.load_device_files(date, ip))
+
+    def device_results(self, date: str, ip: str, elastic_data: Optional[Dict],
+                       dns_data: Optional[Dict]) -> List[Dict]:
+        """由已載入的流量與 DNS 資料產生設備的分析結果"""
         results = []
-        elastic_data = self.load_json_file(self.elastic_base_path / date / f"{ip}.json")
-        dns_data = self.load_json_file(self.dns_base_path / date / f"{ip}.json")
+        site, device_ip = split_device_stem(ip)
+        device = device_label(device_ip, site)
 
         if not elastic_data or not dns_data:
             return []
@@ -80,12 +143,12 @@ class DNSLogAnalyzer:
         processed_ips = set()
 
         # 處理所有DNS解析結果
-        for question_name, answer_ip in dns_mappings[ip]:
+        for question_name, answer_ip in dns_mappings[device_ip]:
             # 獲取訪問次數，如果沒有訪問記錄則為0
             access_count = ip_counts.get(answer_ip, 0)
             results.append({
                 'Date': date,
-                'Device_IP': ip,
+                'Device_IP': device,
                 'DNS_Questions_Name': question_name,
                 'DNS_Answer_A': answer_ip,
                 'Access_IP_Count': access_count
@@ -100,7 +163,7 @@ class DNSLogAnalyzer:
                     dns_name = "DNS Server"
                 results.append({
                     'Date': date,
-                    'Device_IP': ip,
+                    'Device_IP': device,
                     'DNS_Questions_Name': dns_name,
                     'DNS_Answer_A': target_ip,
                     'Access_IP_Count': count
@@ -108,86 +171,409 @@ class DNSLogAnalyzer:
 
         return results
 
-    def analyze_all_devices(self) -> List[Dict]:
-        """分析所有設備在指定時間範圍內的數據"""
+    def iter_file_aggregates(self) -> Iterator[Tuple[Dict[Tuple[str, str], Tuple[int, Optional[str]]], float]]:
+        """逐一處理每個日期/設備檔案，回傳 ({(設備IP, 答案IP): (訪問次數, DNS name)}, 抽樣機率)
+
+        抽樣機率讀取自流量檔案的 metadata，未抽樣的檔案為 1。key 包含設備 IP，
+        因此同一 key 在同一天只會出現在一個檔案中，每個檔案的次數即為該日的觀測值。
+        抽樣的檔案同時以 (網域, 抽樣單位, 抽樣機率) 累計網域層級估計所需的觀測值；
+        未抽樣的次數由最終結果列計算，不另外累計。
+        """
         dates = self.get_date_range()
+        self.sample_units = set()
+        self.domain_units = defaultdict(int)
 
         total_files = sum(len(self.get_available_ips(date)) for date in dates)
         processed_files = 0
 
-        print(f"Analyzing data from {self.start_date.date()} to {self.end_date.date()}")
+        print(f"Analyzing data from {self.effective_range[0]} to {self.effective_range[1]}")
         print(f"Found {len(dates)} dates and {total_files} files to process")
 
-        # 使用字典來合併相同項目的訪問次數
-        consolidated = defaultdict(int)
-        dns_names = {}  # 儲存每個IP對應的DNS name
-
         for date in dates:
             for ip in self.get_available_ips(date):
                 processed_files += 1
                 print(f"Processing {date}/{ip} ({processed_files}/{total_files})")
 
-                results = self.analyze_device(date, ip)
-                for result in results:
+                elastic_data, dns_data = self.load_device_files(date, ip)
+                probability, unit = inclusion_probability((elastic_data or {}).get('metadata'))
+                if unit:
+                    self.sample_units.add(unit)
+                # 依日期抽樣時整天為一個抽樣單位，依設備抽樣時設備為一個抽樣單位
+                sample_unit = date if unit == "day" else ip
+
+                file_counts = {}
+                for result in self.device_results(date, ip, elastic_data, dns_data):
                     key = (result['Device_IP'], result['DNS_Answer_A'])
-                    consolidated[key] += result['Access_IP_Count']
+                    count, dns_name = file_counts.get(key, (0, None))
                     # 保存DNS name的對應關係
                     if result['DNS_Questions_Name'] != "IP direct access":
-                        dns_names[key] = result['DNS_Questions_Name']
+                        dns_name = result['DNS_Questions_Name']
+                    file_counts[key] = (count + result['Access_IP_Count'], dns_name)
+
+                if unit:
+                    for (_, answer_ip), (count, dns_name) in file_counts.items():
+                        domain = self.display_name(answer_ip, dns_name)
+                        self.domain_units[(domain, sample_unit, probability)] += count
+                yield file_counts, probability
+
+    @property
+    def row_estimates(self) -> bool:
+        """是否在每列加上估計欄位
+
+        只有依日期抽樣時每列才有意義；依設備抽樣時被抽中設備的次數是精確值，
+        估計只適用於跨設備的彙總（見 write_domain_estimates）。
+        """
+        return self.sample_units == {"day"}
+
+    @staticmethod
+    def display_name(answer_ip: str, dns_name: Optional[str]) -> str:
+        """輸出的 DNS 名稱"""
+        if answer_ip == "8.8.8.8":
+            return "DNS Server"
+        return dns_name or "IP direct access"
+
+    def build_result_row(self, key: Tuple[str, str], count: int, estimate: float,
+                         variance: float, dns_name: Optional[str]) -> Dict:
+        """建立單一輸出列"""
+        device_ip, answer_ip = key
+        row = {
+            'Device_IP': device_ip,
+            'DNS_Questions_Name': self.display_name(answer_ip, dns_name),
+            'DNS_Answer_A': answer_ip,
+            'Access_IP_Count': count
+        }
+        if self.row_estimates:
+            row['Estimated_Access_Count'] = round(estimate)
+            row['Std_Error'] = round(math.sqrt(variance), 1)
+        return row
+
+    @staticmethod
+    def result_sort_key(row: Dict) -> Tuple:
+        """按訪問次數降序、DNS名稱、答案IP和設備IP升序排序
+
+        包含設備 IP 使排序完全確定，記憶體內排序與外部合併的輸出順序一致。
+        """
+        return (-row['Access_IP_Count'], row['DNS_Questions_Name'], row['DNS_Answer_A'],
+                row['Device_IP'])
+
+    @staticmethod
+    def domain_entry_key(entry: list) -> Tuple:
+        """網域觀測值 [網域, 抽樣單位, 抽樣機率, 次數] 的合併順序"""
+        return entry[0], entry[1], entry[2]
+
+    @staticmethod
+    def domain_sort_key(row: Dict) -> Tuple:
+        """網域估計按估計次數降序、網域名稱升序排序"""
+        return -row['Estimated_Access_Count'], row['DNS_Questions_Name']
+
+    def analyze_all_devices(self) -> List[Dict]:
+        """分析所有設備在指定時間範圍內的數據"""
+        # 使用字典來合併相同項目的訪問次數
+        consolidated = defaultdict(int)
+        dns_names = {}  # 儲存每個IP對應的DNS name
+        # Horvitz-Thompson 估計總數與變異數，依各檔案的抽樣機率加權
+        estimates = defaultdict(float)
+        variances = defaultdict(float)
+        # 來自未抽樣檔案的次數，供網域層級估計使用
+        exact_counts = defaultdict(int)
+
+        for file_counts, probability in self.iter_file_aggregates():
+            for key, (count, dns_name) in file_counts.items():
+                consolidated[key] += count
+                estimate, variance = ht_terms(count, probability)
+                estimates[key] += estimate
+                variances[key] += variance
+                if probability >= 1:
+                    exact_counts[key] += count
+                if dns_name:
+                    dns_names[key] = dns_name
 
         # 轉換回列表格式
-        final_results = []
-        for key, count in consolidated.items():
-            device_ip, answer_ip = key
-            dns_name = dns_names.get(key, "IP direct access")
-            if answer_ip == "8.8.8.8":
-                dns_name = "DNS Server"
-
-            final_results.append({
-                'Device_IP': device_ip,
-                'DNS_Questions_Name': dns_name,
-                'DNS_Answer_A': answer_ip,
-                'Access_IP_Count': count
-            })
+        final_results = [
+            self.build_result_row(key, count, estimates[key], variances[key], dns_names.get(key))
+            for key, count in consolidated.items()
+        ]
+
+        self.domain_exact = defaultdict(int)
+        if self.sample_units:
+            for row in final_results:
+                key = (row['Device_IP'], row['DNS_Answer_A'])
+                if exact_counts.get(key):
+                    self.domain_exact[row['DNS_Questions_Name']] += exact_counts[key]
+        return sorted(final_results, key=self.result_sort_key)
+
+    def analyze_to_csv(self, filename: str, domain_filename: Optional[str] = None) -> None:
+        """分析並寫入 CSV；設定 memory_budget_mb 時以外部排序限制記憶體用量
+
+        資料包含抽樣檔案且指定 domain_filename 時，另外寫入網域層級估計。
+        """
+        if self.memory_budget_mb is None:
+            self.write_csv(self.analyze_all_devices(), filename)
+            if domain_filename and self.sample_units:
+                self.write_domain_estimates(domain_filename)
+            return
+
+        max_entries = max(MIN_BUDGET_ENTRIES,
+                          int(self.memory_budget_mb * 1024 * 1024 / ESTIMATED_ENTRY_BYTES))
+        with tempfile.TemporaryDirectory(prefix="dns_analysis_", dir=self.spill_dir) as spill_dir:
+            runs, domain_runs = self.spill_partial_aggregates(spill_dir, max_entries)
+            print(f"Merging {len(runs)} sorted runs (budget: {max_entries} entries)")
+            if not self.sample_units:
+                domain_runs = None
+            rows = self.merge_final_rows(spill_dir, runs, max_entries, domain_runs)
+            self.write_rows(rows, filename)
+            if domain_filename and domain_runs is not None:
+                self.write_domain_rows(
+                    self.merge_domain_runs(spill_dir, domain_runs, max_entries), domain_filename)
+
+    def spill_partial_aggregates(self, spill_dir: str, max_entries: int) -> Tuple[List[str], List[str]]:
+        """第一階段：累積部分彙總，超過預算時依 key 排序寫出為 run 檔
+
+        抽樣檔案的網域觀測值與部分彙總共用預算，一併寫出為網域 run 檔。
+        """
+        runs = []
+        domain_runs = []
+        # key -> [訪問次數, 估計總數, 變異數, 未抽樣次數, DNS name 序號, DNS name]
+        partial: Dict[Tuple[str, str], list] = {}
+        sequence = 0
+
+        for file_counts, probability in self.iter_file_aggregates():
+            sequence += 1
+            for key, (count, dns_name) in file_counts.items():
+                entry = partial.get(key)
+                if entry is None:
+                    entry = partial[key] = [0, 0.0, 0.0, 0, 0, None]
+                estimate, variance = ht_terms(count, probability)
+                entry[0] += count
+                entry[1] += estimate
+                entry[2] += variance
+                if probability >= 1:
+                    entry[3] += count
+                if dns_name:
+                    entry[4], entry[5] = sequence, dns_name
+            if len(partial) + len(self.domain_units) >= max_entries:
+                runs.append(self.write_run(spill_dir, (
+                    [key[0], key[1], *entry] for key, entry in sorted(partial.items()))))
+                partial = {}
+                self.spill_domain_units(spill_dir, domain_runs)
+
+        if partial:
+            runs.append(self.write_run(spill_dir, (
+                [key[0], key[1], *entry] for key, entry in sorted(partial.items()))))
+        self.spill_domain_units(spill_dir, domain_runs)
+        return runs, domain_runs
+
+    def spill_domain_units(self, spill_dir: str, domain_runs: List[str]) -> None:
+        """將累計的網域觀測值依 (網域, 抽樣單位, 抽樣機率) 排序寫出並清空"""
+        if not self.domain_units:
+            return
+        domain_runs.append(self.write_run(spill_dir, sorted(
+            [domain, unit, probability, count]
+            for (domain, unit, probability), count in self.domain_units.items())))
+        self.domain_units.clear()
+
+    def merge_final_rows(self, spill_dir: str, runs: List[str], max_entries: int,
+                         domain_runs: Optional[List[str]] = None) -> Iterator[Dict]:
+        """第二階段：k-way 合併相同 key，再依輸出順序做外部排序
+
+        指定 domain_runs 時，未抽樣的次數依各列的 DNS 名稱累計，與排序緩衝區各用一半預算，
+        超過時寫出為網域 run 檔並加入 domain_runs。
+        """
+        runs = self.reduce_runs(spill_dir, runs, self.merge_partial_runs)
+        if domain_runs is not None:
+            max_entries = max(1, max_entries // 2)
+        rows = self.collect_exact_counts(
+            self.merge_partial_runs(runs), spill_dir, max_entries, domain_runs)
+        return self.external_sort(spill_dir, rows, self.result_sort_key, max_entries)
+
+    def collect_exact_counts(self, entries: Iterable[list], spill_dir: str, max_entries: int,
+                             domain_runs: Optional[List[str]]) -> Iterator[Dict]:
+        """由合併後的項目產生結果列，同時累計各網域未抽樣的次數"""
+        exact = defaultdict(int)
+        for device_ip, answer_ip, count, estimate, variance, exact_count, _, dns_name in entries:
+            row = self.build_result_row(
+                (device_ip, answer_ip), count, estimate, variance, dns_name)
+            if domain_runs is not None and exact_count:
+                exact[row['DNS_Questions_Name']] += exact_count
+                if len(exact) >= max_entries:
+                    domain_runs.append(self.write_run(spill_dir, (
+                        [domain, "", 1.0, value] for domain, value in sorted(exact.items()))))
+                    exact.clear()
+            yield row
+
+        if exact:
+            domain_runs.append(self.write_run(spill_dir, (
+                [domain, "", 1.0, value] for domain, value in sorted(exact.items()))))
+
+    def merge_domain_runs(self, spill_dir: str, domain_runs: List[str],
+                          max_entries: int) -> Iterator[Dict]:
+        """合併網域 run 檔並計算各網域估計，再依輸出順序做外部排序"""
+        def merge(batch):
+            return self.merge_sorted(batch, self.domain_entry_key)
+
+        domain_runs = self.reduce_runs(spill_dir, domain_runs, merge)
+        rows = self.combine_domain_entries(merge(domain_runs))
+        return self.external_sort(spill_dir, rows, self.domain_sort_key, max_entries)
+
+    def external_sort(self, spill_dir: str, items: Iterable, key, max_entries: int) -> Iterator:
+        """依 key 排序；超過 max_entries 時寫出排序 run 檔再合併"""
+        buffer = []
+        runs = []
+        for item in items:
+            buffer.append(item)
+            if len(buffer) >= max_entries:
+                buffer.sort(key=key)
+                runs.append(self.write_run(spill_dir, buffer))
+                buffer = []
+
+        buffer.sort(key=key)
+        if not runs:
+            yield from buffer
+            return
 
-        # 按訪問次數降序、DNS名稱和答案IP升序排序
-        return sorted(
-            final_results,
-            key=lambda x: (-x['Access_IP_Count'], x['DNS_Questions_Name'], x['DNS_Answer_A'])
-        )
+        if buffer:
+            runs.append(self.write_run(spill_dir, buffer))
+            buffer = []
+        runs = self.reduce_runs(spill_dir, runs, lambda batch: self.merge_sorted(batch, key))
+        yield from self.merge_sorted(runs, key)
+
+    def reduce_runs(self, spill_dir: str, runs: List[str], merge) -> List[str]:
+        """run 檔超過同時開啟上限時分批合併，避免開啟過多檔案"""
+        while len(runs) > MAX_MERGE_FANIN:
+            runs = [self.write_run(spill_dir, merge(runs[i:i + MAX_MERGE_FANIN]))
+                    for i in range(0, len(runs), MAX_MERGE_FANIN)]
+        return runs
+
+    @staticmethod
+    def write_run(spill_dir: str, items: Iterable) -> str:
+        """將已排序的項目逐行寫入 spill_dir 中名稱不重複的 run 檔"""
+        fd, path = tempfile.mkstemp(prefix="run_", suffix=".jsonl", dir=spill_dir)
+        with open(fd, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(fast_json.dumps(item) + "\n")
+        return path
+
+    @staticmethod
+    def read_run(path: str) -> Iterator:
+        """逐行讀取 run 檔"""
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield fast_json.loads(line)
+
+    def merge_partial_runs(self, runs: List[str]) -> Iterator[list]:
+        """合併依 key 排序的部分彙總 run，相同 key 加總次數並保留最後出現的 DNS name"""
+        merged = heapq.merge(*(self.read_run(path) for path in runs),
+                             key=lambda entry: (entry[0], entry[1]))
+        for key, group in groupby(merged, key=lambda entry: (entry[0], entry[1])):
+            count, estimate, variance, exact_count, sequence, dns_name = 0, 0.0, 0.0, 0, 0, None
+            for entry in group:
+                count += entry[2]
+                estimate += entry[3]
+                variance += entry[4]
+                exact_count += entry[5]
+                if entry[7] and entry[6] > sequence:
+                    sequence, dns_name = entry[6], entry[7]
+            yield [key[0], key[1], count, estimate, variance, exact_count, sequence, dns_name]
+
+    def merge_sorted(self, runs: List[str], key) -> Iterator:
+        """合併依 key 排序的 run 檔"""
+        return heapq.merge(*(self.read_run(path) for path in runs), key=key)
+
+    def result_fieldnames(self) -> List[str]:
+        """CSV 欄位"""
+        fieldnames = ['Device_IP', 'DNS_Questions_Name', 'DNS_Answer_A', 'Access_IP_Count']
+        if self.row_estimates:
+            fieldnames += ['Estimated_Access_Count', 'Std_Error']
+        return fieldnames
 
     def write_csv(self, results: List[Dict], filename: str) -> None:
         """寫入CSV文件"""
-        if not results:
+        self.write_rows(results, filename)
+
+    def write_rows(self, rows: Iterable[Dict], filename: str) -> None:
+        """逐列寫入CSV文件，不需要將所有結果保留在記憶體中；沒有結果時不建立檔案"""
+        rows = iter(rows)
+        first_row = next(rows, None)
+        if first_row is None:
             print("No results to write")
             return
 
-        fieldnames = ['Device_IP', 'DNS_Questions_Name', 'DNS_Answer_A', 'Access_IP_Count']
+        total = 0
         with open(filename, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer = csv.DictWriter(f, fieldnames=self.result_fieldnames())
             writer.writeheader()
-            writer.writerows(results)
+            for row in chain([first_row], rows):
+                writer.writerow(row)
+                total += 1
 
         print(f"Results written to {filename}")
-        print(f"Total records: {len(results)}")
+        print(f"Total records: {total}")
+
+    @staticmethod
+    def combine_domain_entries(entries: Iterable[list]) -> Iterator[Dict]:
+        """由依 (網域, 抽樣單位, 抽樣機率) 排序的觀測值計算各網域的估計總數與標準誤差
+
+        同一抽樣單位的次數先加總再計算 Horvitz-Thompson 項，依日期或依設備抽樣都適用；
+        未抽樣的次數（抽樣機率 1）變異數為 0。
+        """
+        for domain, group in groupby(entries, key=lambda entry: entry[0]):
+            count, estimate, variance = 0, 0.0, 0.0
+            for (_, _, probability), unit_group in groupby(
+                    group, key=DNSLogAnalyzer.domain_entry_key):
+                value = sum(entry[3] for entry in unit_group)
+                unit_estimate, unit_variance = ht_terms(value, probability)
+                count += value
+                estimate += unit_estimate
+                variance += unit_variance
+            yield {
+                'DNS_Questions_Name': domain,
+                'Access_IP_Count': count,
+                'Estimated_Access_Count': round(estimate),
+                'Std_Error': round(math.sqrt(variance), 1)
+            }
+
+    def domain_estimates(self) -> List[Dict]:
+        """跨設備的網域層級估計：每個網域的總訪問次數與標準誤差，需在 analyze_all_devices 後呼叫"""
+        entries = sorted(
+            [[domain, unit, probability, count]
+             for (domain, unit, probability), count in self.domain_units.items()] +
+            [[domain, "", 1.0, count] for domain, count in self.domain_exact.items()])
+        return sorted(self.combine_domain_entries(entries), key=self.domain_sort_key)
+
+    def write_domain_estimates(self, filename: str) -> None:
+        """寫入網域層級估計 CSV，需在 analyze_all_devices 後呼叫"""
+        self.write_domain_rows(self.domain_estimates(), filename)
+
+    @staticmethod
+    def write_domain_rows(rows: Iterable[Dict], filename: str) -> None:
+        """逐列寫入網域層級估計 CSV"""
+        fieldnames = ['DNS_Questions_Name', 'Access_IP_Count', 'Estimated_Access_Count', 'Std_Error']
+        total = 0
+        with open(filename, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                total += 1
 
+        print(f"Domain estimates written to {filename}")
+        print(f"Total domains: {total}")
 
 def main():
     # 指定分析的時間範圍
     start_date = "2024-10-13"
     end_date = "2024-10-19"
+    # 記憶體預算（MB），None 表示全部在記憶體中處理
+    memory_budget_mb = None
 
-    # 建立分析器實例
-    analyzer = DNSLogAnalyzer(start_date, end_date)
-
-    # 執行分析
-    results = analyzer.analyze_all_devices()
+    # 建立分析器實例（抽樣設定讀取自收集結果的 metadata）
+    analyzer = DNSLogAnalyzer(start_date, end_date, memory_budget_mb)
 
-    # 生成包含時間範圍的輸出文件名
-    output_file = f"dns_analysis_{start_date}_to_{end_date}.csv"
+    # 生成包含實際時間範圍的輸出文件名（與彙總期間部分重疊時會擴大）
+    output_file = analyzer.output_filename("dns_analysis")
 
-    # 寫入結果
-    analyzer.write_csv(results, output_file)
+    # 執行分析並寫入結果；資料包含抽樣檔案時，另外輸出跨設備的網域層級估計
+    analyzer.analyze_to_csv(output_file, analyzer.output_filename("dns_domain_estimate"))
 
     print("\nAnalysis complete!")
 
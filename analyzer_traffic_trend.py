@@ -1,36 +1,102 @@
 import csv
-import json
 import os
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
+
+import fast_json
+from comparison_engine import LagComparisonEngine
+from compactor_retention import list_periods
+from report_state import ReportState
+from sampling import estimate_totals, inclusion_probability
+from site_shard import device_label, is_date_dir
+
+REPORT_FIELDNAMES = [
+    "比較日期區間",
+    "來源IP",
+    "目標IP",
+    "IP狀態",
+    "前一天連線次數",
+    "當天連線次數",
+    "連線次數變化",
+    "變化趨勢",
+    "變化幅度"
+]
 
 
 class ElasticTrafficAnalyzer:
-    def __init__(self, input_dir: str = "elastic_query_results"):
-        """Initialize the analyzer with the input directory containing collected data"""
+    def __init__(self, input_dir: str = "elastic_query_results", preload: bool = True):
+        """Initialize the analyzer with the input directory containing collected data
+
+        With preload=False days are loaded on demand, which incremental reports use
+        to read only the days involved in new comparisons.
+        """
         self.input_dir = input_dir
         self.daily_ip_data = {}
-        self.load_collected_data()
+        # sampling[date][device] = (抽樣機率, 抽樣單位)，讀取自收集結果的 metadata
+        self.sampling = {}
+        self.periods = {}
+        if preload:
+            self.load_collected_data()
+
+    def list_dates(self) -> List[str]:
+        """List the collected days in ascending order
+
+        Compacted weekly/monthly rollups are skipped: their totals are not
+        comparable with a single day under the 前一天/當天 columns.
+        """
+        # 略過 sites/ 等非日期目錄，彙總期間（start..end）不納入逐日比較
+        self.periods = list_periods(self.input_dir)
+        rollups = [label for label in self.periods if not is_date_dir(label)]
+        if rollups:
+            print(f"略過 {len(rollups)} 個已彙總的期間，趨勢報告只比較每日資料")
+        return sorted(label for label in self.periods if is_date_dir(label))
 
     def load_collected_data(self) -> None:
         """Load all collected JSON data from the input directory"""
-        for date_dir in os.listdir(self.input_dir):
-            if os.path.isdir(os.path.join(self.input_dir, date_dir)):
-                self.daily_ip_data[date_dir] = {}
-                date_path = os.path.join(self.input_dir, date_dir)
-
-                for ip_file in os.listdir(date_path):
-                    if ip_file.endswith('.json'):
-                        with open(os.path.join(date_path, ip_file), 'r', encoding='utf-8') as f:
-                            try:
-                                data = json.load(f)
-                                ip = data['metadata']['source_ip']
-                                self.daily_ip_data[date_dir][ip] = data['data']
-                            except json.JSONDecodeError:
-                                print(f"Warning: Could not parse {ip_file}")
-                            except KeyError:
-                                print(
-                                    f"Warning: Invalid data format in {ip_file}")
+        for date_dir in self.list_dates():
+            self.load_date_data(date_dir)
+
+    def load_missing_dates(self) -> None:
+        """Load every collected day that is not loaded yet
+
+        Incremental reports load only the days of new pairs; reports that
+        span all days call this first.
+        """
+        for date_dir in self.list_dates():
+            if date_dir not in self.daily_ip_data:
+                self.load_date_data(date_dir)
+
+    def load_date_data(self, date_dir: str) -> None:
+        """Load the collected JSON data of a single day or rollup period"""
+        self.daily_ip_data[date_dir] = {}
+        self.sampling[date_dir] = {}
+        date_path = self.periods.get(date_dir, os.path.join(self.input_dir, date_dir))
+
+        for ip_file in os.listdir(date_path):
+            if ip_file.endswith('.json'):
+                with open(os.path.join(date_path, ip_file), 'r', encoding='utf-8') as f:
+                    try:
+                        data = fast_json.load(f)
+                        metadata = data['metadata']
+                        device = device_label(metadata['source_ip'], metadata.get('site'))
+                        self.daily_ip_data[date_dir][device] = data['data']
+                        self.sampling[date_dir][device] = inclusion_probability(metadata)
+                    except fast_json.JSONDecodeError:
+                        print(f"Warning: Could not parse {ip_file}")
+                    except KeyError:
+                        print(
+                            f"Warning: Invalid data format in {ip_file}")
+
+    def sample_units(self) -> set:
+        """已載入資料使用的抽樣單位，完整收集的資料不列入"""
+        return {unit for devices in self.sampling.values()
+                for _, unit in devices.values() if unit}
+
+    def check_sampling(self) -> None:
+        """依日期抽樣的資料只有部分日期，相鄰的收集日期並非前一天，不適用趨勢比較"""
+        if "day" in self.sample_units():
+            raise ValueError("趨勢報告不支援依日期抽樣（sample_unit=\"day\"）的資料，"
+                             "請改用依設備抽樣（sample_unit=\"device\"）收集")
 
     def compare_days(self, prev_result: Dict[str, int],
                      curr_result: Dict[str, int]) -> Dict[str, dict]:
@@ -49,97 +115,198 @@ class ElasticTrafficAnalyzer:
             "maintained": maintained_ips
         }
 
-    def generate_csv_report(self, output_dir: str = "analysis_results") -> str:
-        """Generate and save the IP comparison report in CSV format"""
+    def write_comparison_rows(self, writer: csv.DictWriter, date1: str, date2: str) -> None:
+        """Write the comparison rows of one date pair"""
+        date_range = f"{date1} to {date2}"
+
+        for source_ip in self.daily_ip_data[date1].keys():
+            prev_results = self.daily_ip_data[date1].get(source_ip, {})
+            curr_results = self.daily_ip_data[date2].get(source_ip, {})
+
+            comparison = self.compare_days(prev_results, curr_results)
+
+            # Write new IPs
+            for ip, count in comparison["added"].items():
+                writer.writerow({
+                    "比較日期區間": date_range,
+                    "來源IP": source_ip,
+                    "目標IP": ip,
+                    "IP狀態": "新增",
+                    "前一天連線次數": 0,
+                    "當天連線次數": count,
+                    "連線次數變化": count,
+                    "變化趨勢": "新增",
+                    "變化幅度": count
+                })
+
+            # Write removed IPs
+            for ip, count in comparison["removed"].items():
+                writer.writerow({
+                    "比較日期區間": date_range,
+                    "來源IP": source_ip,
+                    "目標IP": ip,
+                    "IP狀態": "移除",
+                    "前一天連線次數": count,
+                    "當天連線次數": 0,
+                    "連線次數變化": -count,
+                    "變化趨勢": "移除",
+                    "變化幅度": count
+                })
+
+            # Write maintained IPs
+            for ip, (prev_count, curr_count) in comparison["maintained"].items():
+                change = curr_count - prev_count
+                trend = "增加" if change > 0 else "減少" if change < 0 else "不變"
+
+                writer.writerow({
+                    "比較日期區間": date_range,
+                    "來源IP": source_ip,
+                    "目標IP": ip,
+                    "IP狀態": "維持",
+                    "前一天連線次數": prev_count,
+                    "當天連線次數": curr_count,
+                    "連線次數變化": change,
+                    "變化趨勢": trend,
+                    "變化幅度": abs(change)
+                })
+
+    def generate_csv_report(self, output_dir: str = "analysis_results",
+                            incremental: bool = False) -> str:
+        """Generate and save the IP comparison report in CSV format
+
+        In incremental mode rows are appended to a rolling report, and only the
+        date pairs that are not yet recorded in its state file are computed.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+
+        if incremental:
+            csv_report_file = os.path.join(output_dir, "ip_traffic_analysis.csv")
+            state = ReportState(csv_report_file)
+            dates = self.list_dates()
+            # 補收集中間日期後，原本的比較組合已不相鄰，先從報告移除
+            state.remove_stale_pairs(dates)
+            pairs = state.pending_pairs(dates)
+            # 只載入新比較組合涉及的日期
+            for date_str in {date for pair in pairs for date in pair}:
+                if date_str not in self.daily_ip_data:
+                    self.load_date_data(date_str)
+            self.check_sampling()
+            write_header = not os.path.exists(csv_report_file)
+            mode = 'a'
+        else:
+            self.check_sampling()
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            csv_report_file = os.path.join(
+                output_dir, f"ip_traffic_analysis_{timestamp}.csv")
+            dates = sorted(self.daily_ip_data.keys())
+            pairs = [(dates[i], dates[i + 1]) for i in range(len(dates) - 1)]
+            write_header = True
+            mode = 'w'
+
+        with open(csv_report_file, mode, newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=REPORT_FIELDNAMES)
+            if write_header:
+                writer.writeheader()
+
+            for date1, date2 in pairs:
+                self.write_comparison_rows(writer, date1, date2)
+
+        if incremental:
+            state.mark_done(pairs)
+            print(f"新增 {len(pairs)} 組日期比較")
+
+        print(f"分析報告已儲存到: {csv_report_file}")
+        return csv_report_file
+
+    def generate_lag_report(self, lags: List[str],
+                            output_dir: str = "analysis_results") -> str:
+        """Generate a multi-lag comparison report (e.g. lag:1, lag:7, weekday:4, trailing:7)
+
+        Each day is converted to a sorted array once and every lag is computed
+        with merge joins in a single pass over the dates.
+        """
+        # 每個日期都是比較對象，也可能是其他日期的基準，因此需要所有日期
+        self.load_missing_dates()
+        os.makedirs(output_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        csv_report_file = os.path.join(
+            output_dir, f"ip_traffic_lag_analysis_{timestamp}.csv")
+
+        engine = LagComparisonEngine(self.daily_ip_data)
+        rows = engine.write_csv(lags, csv_report_file)
+
+        print(f"多間隔比較報告已儲存到: {csv_report_file}（{rows} 筆）")
+        return csv_report_file
+
+    def generate_estimate_report(self, output_dir: str = "analysis_results") -> str:
+        """Estimate fleet-wide daily connection totals from device-sampled data
+
+        Each device file is one Horvitz-Thompson unit weighted by the inclusion
+        probability stored in its metadata; files collected without sampling
+        count exactly. Day-sampled data is rejected (see check_sampling).
+        """
+        # 增量模式只載入了新比較組合的日期，估計報告涵蓋所有日期
+        self.load_missing_dates()
+        self.check_sampling()
         os.makedirs(output_dir, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         csv_report_file = os.path.join(
-            output_dir, f"ip_traffic_analysis_{timestamp}.csv")
+            output_dir, f"ip_traffic_estimate_{timestamp}.csv")
+
+        estimates = {}
+        for date_str, devices in self.daily_ip_data.items():
+            estimates[date_str] = estimate_totals(
+                (sum(counts.values()), self.sampling[date_str][device][0])
+                for device, counts in devices.items())
 
         fieldnames = [
             "比較日期區間",
-            "來源IP",
-            "目標IP",
-            "IP狀態",
-            "前一天連線次數",
-            "當天連線次數",
-            "連線次數變化",
-            "變化趨勢",
-            "變化幅度"
+            "前一天估計連線次數",
+            "前一天標準誤差",
+            "當天估計連線次數",
+            "當天標準誤差",
+            "估計變化"
         ]
-
-        dates = sorted(self.daily_ip_data.keys())
+        dates = sorted(estimates.keys())
 
         with open(csv_report_file, 'w', newline='', encoding='utf-8') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
 
-            for i in range(len(dates) - 1):
-                date1, date2 = dates[i], dates[i + 1]
-                date_range = f"{date1} to {date2}"
-
-                for source_ip in self.daily_ip_data[date1].keys():
-                    prev_results = self.daily_ip_data[date1].get(source_ip, {})
-                    curr_results = self.daily_ip_data[date2].get(source_ip, {})
-
-                    comparison = self.compare_days(prev_results, curr_results)
-
-                    # Write new IPs
-                    for ip, count in comparison["added"].items():
-                        writer.writerow({
-                            "比較日期區間": date_range,
-                            "來源IP": source_ip,
-                            "目標IP": ip,
-                            "IP狀態": "新增",
-                            "前一天連線次數": 0,
-                            "當天連線次數": count,
-                            "連線次數變化": count,
-                            "變化趨勢": "新增",
-                            "變化幅度": count
-                        })
-
-                    # Write removed IPs
-                    for ip, count in comparison["removed"].items():
-                        writer.writerow({
-                            "比較日期區間": date_range,
-                            "來源IP": source_ip,
-                            "目標IP": ip,
-                            "IP狀態": "移除",
-                            "前一天連線次數": count,
-                            "當天連線次數": 0,
-                            "連線次數變化": -count,
-                            "變化趨勢": "移除",
-                            "變化幅度": count
-                        })
-
-                    # Write maintained IPs
-                    for ip, (prev_count, curr_count) in comparison["maintained"].items():
-                        change = curr_count - prev_count
-                        trend = "增加" if change > 0 else "減少" if change < 0 else "不變"
-
-                        writer.writerow({
-                            "比較日期區間": date_range,
-                            "來源IP": source_ip,
-                            "目標IP": ip,
-                            "IP狀態": "維持",
-                            "前一天連線次數": prev_count,
-                            "當天連線次數": curr_count,
-                            "連線次數變化": change,
-                            "變化趨勢": trend,
-                            "變化幅度": abs(change)
-                        })
+            for date1, date2 in zip(dates, dates[1:]):
+                (prev_total, prev_error), (curr_total, curr_error) = estimates[date1], estimates[date2]
+                writer.writerow({
+                    "比較日期區間": f"{date1} to {date2}",
+                    "前一天估計連線次數": round(prev_total),
+                    "前一天標準誤差": round(prev_error, 1),
+                    "當天估計連線次數": round(curr_total),
+                    "當天標準誤差": round(curr_error, 1),
+                    "估計變化": round(curr_total - prev_total)
+                })
 
-        print(f"分析報告已儲存到: {csv_report_file}")
+        print(f"估計報告已儲存到: {csv_report_file}")
         return csv_report_file
 
 
 def main():
-    # 建立分析器實例
-    analyzer = ElasticTrafficAnalyzer()
+    # 每日排程可改為 True，只追加新收集日期的比較結果
+    INCREMENTAL = False
+    # 額外的多間隔比較，例如 ["lag:1", "lag:7", "weekday:4", "trailing:7"]
+    LAGS = []
+
+    # 建立分析器實例（增量模式下按需載入日期）
+    analyzer = ElasticTrafficAnalyzer(preload=not INCREMENTAL)
 
     try:
         # 生成 CSV 報告
-        csv_report_file = analyzer.generate_csv_report()
+        csv_report_file = analyzer.generate_csv_report(incremental=INCREMENTAL)
+        if LAGS:
+            analyzer.generate_lag_report(LAGS)
+        # 收集結果包含依設備抽樣的資料時，另外輸出估計總連線次數報告
+        # （增量模式下先載入其餘日期才能判斷）
+        analyzer.load_missing_dates()
+        if analyzer.sample_units():
+            analyzer.generate_estimate_report()
         print("\n分析完成！")
         print(f"報告檔案: {csv_report_file}")
 
@@ -1,4 +1,3 @@
-import json
 import os
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
@@ -7,6 +6,13 @@ import requests
 import urllib3
 from requests.auth import HTTPBasicAuth
 
+import fast_json
+from detector_dns_tunnel import DNSTunnelDetector
+from device_discovery import DeviceDiscovery
+from index_resolver import DailyIndexResolver
+from sampling import Sampler
+from site_shard import SiteShard
+
 # 禁用 SSL 警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -36,10 +42,16 @@ class DateRange:
 
 class ElasticsearchQueryClient:    
     """Elasticsearch 查詢客戶端"""
-    def __init__(self, host: str, username: str, password: str):
+    def __init__(self, host: str, username: str, password: str,
+                 retention_days: Optional[int] = None,
+                 summary_index: Optional[str] = None):
+        """指定 summary_index 時改為讀取 setup_es_transforms 建立的每日 DNS 摘要索引"""
         self.host = host
         self.auth = HTTPBasicAuth(username, password)
         self.headers = {"Content-Type": "application/json"}
+        self.summary_index = summary_index
+        self.index_resolver = DailyIndexResolver(
+            host, self.auth, "pi-dnsmonster*", retention_days)
 
     def read_ip_list(self, file_path: str) -> List[str]:
         """讀取 IP 列表"""
@@ -71,7 +83,8 @@ class ElasticsearchQueryClient:
             "_source": [
                 "Timestamp",
                 "DNS.Question.Name",
-                "DNS.Answer.A",
+                "DNS.Answer",
+                "DNS.MsgHdr.Rcode",
                 "DstIP",
                 "SrcIP",
                 "Protocol"
@@ -82,23 +95,79 @@ class ElasticsearchQueryClient:
             "size": 10000
         }
 
+    def build_summary_query(self, ip: str, start_time: str, end_time: str) -> Dict:
+        """建立每日 DNS 摘要索引的查詢"""
+        return {
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"DstIP": ip}},
+                        {"range": {"day": {"gte": start_time, "lte": end_time}}}
+                    ]
+                }
+            },
+            "_source": ["day", "DstIP", "question", "answer", "count"],
+            "size": 10000
+        }
+
+    def process_summary_data(self, source: Dict) -> Dict:
+        """將摘要文件轉為與 process_dns_data 相同格式的紀錄"""
+        answer = source.get('answer')
+        return {
+            'timestamp': source['day'],
+            'dst_ip': source['DstIP'],
+            'question_name': source.get('question') or "",
+            'answer_ips': [answer] if answer else [],
+            'count': source.get('count', 0),
+            'src_ip': "",
+            'protocol': ""
+        }
+
+    def query_summary_records(self, ip: str, start_time: str, end_time: str) -> Optional[Dict]:
+        """從每日 DNS 摘要索引查詢預先彙總的紀錄"""
+        try:
+            response = requests.post(
+                f"{self.host}/{self.summary_index}/_search",
+                auth=self.auth,
+                headers=self.headers,
+                data=fast_json.dumps(self.build_summary_query(ip, start_time, end_time)),
+                verify=False,
+                timeout=30
+            )
+
+            if response.status_code == 200:
+                hits = fast_json.loads(response.content).get('hits', {}).get('hits', [])
+                return {'records': [self.process_summary_data(hit['_source']) for hit in hits]}
+            else:
+                print(f"查詢 IP {ip} 失敗，狀態碼：{response.status_code}")
+                print(f"回應內容：{response.text}")
+                return None
+
+        except Exception as e:
+            print(f"查詢 IP {ip} 時發生錯誤：{str(e)}")
+            return None
+
     def process_dns_data(self, source: Dict) -> Dict:
         """處理 DNS 資料"""
         dns_data = source.get('DNS', {})
         question_name = ""
         answer_ips = []
+        answers = dns_data.get('Answer') or []
 
         if 'Question' in dns_data and dns_data['Question']:
             question_name = dns_data['Question'][0].get('Name', '')
 
-        if 'Answer' in dns_data and dns_data['Answer']:
-            answer_ips = [answer['A'] for answer in dns_data['Answer'] if 'A' in answer]
+        if answers:
+            answer_ips = [answer['A'] for answer in answers if 'A' in answer]
 
         return {
             'timestamp': source['Timestamp'],
             'dst_ip': source['DstIP'],
             'question_name': question_name,
             'answer_ips': answer_ips,
+            # 所有類型的 answer 數量（AAAA、CNAME、HTTPS 等），供偵測器判斷無回應
+            'answer_count': len(answers),
+            'rcode': dns_data.get('MsgHdr', {}).get('Rcode'),
             'src_ip': source['SrcIP'],
             'protocol': source['Protocol']
         }
@@ -108,30 +177,44 @@ class ElasticsearchQueryClient:
         if os.path.exists(file_path):
             try:
                 with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                    data = fast_json.load(f)
                     if 'records' in data:  # 檢查文件格式是否正確
                         return True
-            except (json.JSONDecodeError, KeyError):
+            except (fast_json.JSONDecodeError, KeyError):
                 print(f"檔案 {file_path} 存在但格式無效")
                 return False
         return False
 
     def query_dns_records(self, ip: str, start_time: str, end_time: str) -> Optional[Dict]:
         """查詢 DNS 記錄"""
+        if self.summary_index:
+            return self.query_summary_records(ip, start_time, end_time)
+
+        # 只查詢時間範圍內的每日索引，而非所有歷史索引
+        indices = self.index_resolver.resolve(start_time, end_time)
+        if not indices:
+            print(f"{start_time} 至 {end_time} 沒有可用的索引，略過 IP {ip}")
+            return None
+
         query = self.build_query(ip, start_time, end_time)
 
         try:
             response = requests.post(
-                f"{self.host}/pi-dnsmonster*/_search",
+                f"{self.host}/{','.join(indices)}/_search?ignore_unavailable=true",
                 auth=self.auth,
                 headers=self.headers,
-                data=json.dumps(query),
+                data=fast_json.dumps(query),
                 verify=False,
                 timeout=30
             )
 
             if response.status_code == 200:
-                json_response = response.json()
+                # msgspec 可用時直接解碼為具型別的 _source 結構
+                results = fast_json.decode_dns_records(response.content)
+                if results is not None:
+                    return {'records': results}
+
+                json_response = fast_json.loads(response.content)
                 results = []
 
                 if 'hits' in json_response and 'hits' in json_response['hits']:
@@ -149,9 +232,25 @@ class ElasticsearchQueryClient:
             print(f"查詢 IP {ip} 時發生錯誤：{str(e)}")
             return None
 
-    def collect_data(self, start_date: str, end_date: str, ip_list_file: str, output_dir: str):
-        """收集 DNS 查詢資料"""
-        ip_list = self.read_ip_list(ip_list_file)
+    def collect_data(self, start_date: str, end_date: str, ip_list_file: Optional[str],
+                     output_dir: str, shard: Optional[SiteShard] = None,
+                     discovery: Optional[DeviceDiscovery] = None,
+                     detector: Optional[DNSTunnelDetector] = None,
+                     sampler: Optional[Sampler] = None):
+        """收集 DNS 查詢資料
+
+        指定分片時只查詢該分片負責的設備，結果寫入站點分片目錄，
+        之後由 merge_site_partitions 合併。
+        指定設備探索時每天只查詢當天有 DNS 紀錄的設備，IP 列表僅作為備援。
+        指定偵測器時新查詢到的紀錄會同步送入偵測器，告警寫入 dns_alerts.csv。
+        指定抽樣器時只查詢被抽中的日期或設備。
+        """
+        ip_list = self.read_ip_list(ip_list_file) if ip_list_file else []
+        site = None
+        if shard:
+            site = shard.site
+            output_dir = shard.partition_dir(output_dir)
+            print(f"站點 {site} 分片 {shard.shard_index + 1}/{shard.shard_count}")
         date_range = DateRange(start_date, end_date)
         dates = date_range.get_dates()
 
@@ -159,11 +258,27 @@ class ElasticsearchQueryClient:
         new_queries_performed = False
 
         for date in dates:
+            if sampler and sampler.unit == "day" and not sampler.keep(date, ""):
+                print(f"未抽中日期 {date}，略過")
+                continue
+
             start_time, end_time = date_range.get_date_range_for_query(date)
             date_dir = os.path.join(output_dir, date)
             os.makedirs(date_dir, exist_ok=True)
 
-            for ip in ip_list:
+            day_ips = ip_list
+            if discovery:
+                active_ips = discovery.discover("dns", start_time, end_time)
+                # 探索失敗時退回靜態 IP 列表
+                if active_ips is not None:
+                    day_ips = active_ips
+                    print(f"{date} 探索到 {len(day_ips)} 個活躍設備")
+            if shard:
+                day_ips = shard.select(day_ips)
+            if sampler:
+                day_ips = [ip for ip in day_ips if sampler.keep(date, ip)]
+
+            for ip in day_ips:
                 file_path = os.path.join(date_dir, f"{ip}.json")
 
                 # 檢查是否已有有效的查詢結果
@@ -174,12 +289,24 @@ class ElasticsearchQueryClient:
                 print(f"查詢 IP: {ip}, 日期: {date}")
                 result = self.query_dns_records(ip, start_time, end_time)
 
+                # 摘要紀錄已失去逐筆時間資訊，偵測器只處理原始紀錄
+                if result and detector and not self.summary_index:
+                    for record in result['records']:
+                        detector.observe(record)
+
                 if result:
+                    result['metadata'] = {'source_ip': ip, 'query_date': date, 'site': site}
+                    if sampler:
+                        result['metadata'].update(sampler.metadata())
                     with open(file_path, 'w', encoding='utf-8') as f:
-                        json.dump(result, f, ensure_ascii=False, indent=2)
+                        fast_json.dump(result, f)
                     print(f"已儲存到 {file_path}")
                     new_queries_performed = True
 
+        if detector:
+            detector.flush()
+            detector.write_alerts(os.path.join(output_dir, "dns_alerts.csv"))
+
         if not new_queries_performed:
             print("所有查詢結果已存在，未執行新的查詢")
         else:
@@ -195,20 +322,38 @@ def main():
     OUTPUT_DIR = "dns_query_results"
     START_DATE = "2024-10-13"
     END_DATE = "2024-10-19"
+    RETENTION_DAYS = None  # 例如 90：超過保留期限的日期不送出查詢
+    SUMMARY_INDEX = None  # 例如 "milix-dns-daily"：讀取 setup_es_transforms 建立的摘要索引
+    DEVICE_SUBNET = None  # 例如 "192.168.1.0/24"：自動探索活躍設備，取代 ip_list.txt
+    SAMPLE_PROBABILITY = 1.0  # 小於 1 時啟用近似模式，只查詢抽中的日期或設備
+    SAMPLE_UNIT = "device"  # 與流量收集器相同，兩者的抽樣設定需一致
 
     try:
+        # 多站點部署時由 MILIX_SITE 等環境變數指定分片
+        shard = SiteShard.from_env()
         client = ElasticsearchQueryClient(
             ELASTICSEARCH_HOST,
             USERNAME,
-            PASSWORD
+            PASSWORD,
+            RETENTION_DAYS,
+            SUMMARY_INDEX
         )
+        discovery = None
+        if DEVICE_SUBNET:
+            discovery = DeviceDiscovery(
+                ELASTICSEARCH_HOST, client.auth, DEVICE_SUBNET,
+                retention_days=RETENTION_DAYS)
 
         print("開始收集資料...")
         client.collect_data(
             START_DATE,
             END_DATE,
             IP_LIST_FILE,
-            OUTPUT_DIR
+            OUTPUT_DIR,
+            shard,
+            discovery,
+            DNSTunnelDetector(),
+            Sampler(SAMPLE_PROBABILITY, SAMPLE_UNIT) if SAMPLE_PROBABILITY < 1 else None
         )
 
         print("查詢完成")
@@ -1,24 +1,39 @@
-import json
 import os
 import sys
 from datetime import datetime, timedelta
-from typing import Dict, Generator, List, Optional
+from typing import Dict, Generator, List, Optional, Tuple
 
 import requests
 import urllib3
 from requests.auth import HTTPBasicAuth
 
+import fast_json
+from device_discovery import DeviceDiscovery
+from index_resolver import DailyIndexResolver
+from report_state import ReportState
+from sampling import Sampler
+from site_shard import SiteShard
+
 # 禁用 SSL 警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 class ElasticsearchQueryClient:
-    def __init__(self, host: str, username: str, password: str):
-        """Initialize the Elasticsearch query client."""
+    def __init__(self, host: str, username: str, password: str,
+                 retention_days: Optional[int] = None,
+                 summary_index: Optional[str] = None):
+        """Initialize the Elasticsearch query client.
+
+        When summary_index is set (see setup_es_transforms), queries read the
+        pre-aggregated daily summary instead of raw Arkime sessions.
+        """
         self.host = host
         self.auth = HTTPBasicAuth(username, password)
         self.headers = {"Content-Type": "application/json"}
         self.daily_ip_data = {}
+        self.summary_index = summary_index
+        self.index_resolver = DailyIndexResolver(
+            host, self.auth, "arkime_sessions3*", retention_days)
 
     def generate_date_ranges(self, start_date: str, end_date: str) -> Generator[tuple, None, None]:
         """Generate daily date ranges between start and end dates."""
@@ -41,23 +56,46 @@ class ElasticsearchQueryClient:
 
     def query_single_ip(self, ip: str, start_time: str, end_time: str) -> Optional[str]:
         """Query Elasticsearch for a single IP address in a specific time range."""
+        if self.summary_index:
+            # 讀取 transform 預先彙總的每日摘要，只需加總已計算好的次數
+            query = {
+                "query": f"""
+                    SELECT "destination.ip", SUM("count") as count
+                    FROM "{self.summary_index}"
+                    WHERE "source.ip" = '{ip}'
+                    AND "day" >= '{start_time}'
+                    AND "day" < '{end_time}'
+                    GROUP BY "destination.ip"
+                """
+            }
+            return self.post_sql(ip, query)
+
+        # 只查詢時間範圍內的每日索引，而非所有歷史索引
+        indices = self.index_resolver.resolve(start_time, end_time)
+        if not indices:
+            print(f"{start_time} 至 {end_time} 沒有可用的索引，略過 IP {ip}")
+            return None
+
         query = {
             "query": f"""
                 SELECT "destination.ip", COUNT(*) as count
-                FROM "arkime_sessions3*"
+                FROM "{','.join(indices)}"
                 WHERE "source.ip" = '{ip}'
                 AND "@timestamp" >= '{start_time}'
                 AND "@timestamp" < '{end_time}'
                 GROUP BY "destination.ip"
             """
         }
+        return self.post_sql(ip, query)
 
+    def post_sql(self, ip: str, query: Dict) -> Optional[str]:
+        """Send an SQL query and return the raw JSON response text."""
         try:
             response = requests.post(
                 f"{self.host}/_sql?format=json",  # 改為請求 JSON 格式
                 auth=self.auth,
                 headers=self.headers,
-                data=json.dumps(query),
+                data=fast_json.dumps(query),
                 verify=False
             )
 
@@ -72,55 +110,41 @@ class ElasticsearchQueryClient:
             print(f"查詢 IP {ip} 時發生錯誤：{e}")
             return None
 
-    def parse_query_result(self, result_text: str) -> Dict[str, int]:
-        """Parse the JSON format query result and extract destination IPs with their counts.
+    def decode_query_result(self, result_text: str) -> Optional[Tuple[List[Dict], List[list]]]:
+        """Decode an SQL response once into its columns and rows.
 
         Args:
             result_text: JSON string containing the query results
 
         Returns:
-            Dictionary with IP addresses as keys and their counts as values
+            (columns, rows), or None when the response lacks either of them
+
+        Raises:
+            fast_json.JSONDecodeError: the response is not valid JSON
         """
-        if not result_text:
-            return {}
+        # msgspec 可用時直接解碼為具型別的 columns / rows
+        typed_result = fast_json.decode_sql_result(result_text)
+        if typed_result is not None:
+            return typed_result
+
+        # 解析 JSON 字串並確認必要的資料結構存在
+        result_json = fast_json.loads(result_text)
+        if not isinstance(result_json, dict) or not all(key in result_json for key in ['columns', 'rows']):
+            print("警告：回傳的 JSON 格式不正確")
+            return None
+        return result_json['columns'], result_json['rows']
 
-        try:
-            # 解析 JSON 字串
-            result_json = json.loads(result_text)
-
-            # 確認必要的資料結構存在
-            if not all(key in result_json for key in ['columns', 'rows']):
-                print("警告：回傳的 JSON 格式不正確")
-                return {}
-
-            # 找出 IP 和 count 的欄位索引
-            ip_idx = -1
-            count_idx = -1
-            for i, column in enumerate(result_json['columns']):
-                if column['name'] == 'destination.ip':
-                    ip_idx = i
-                elif column['name'] == 'count':
-                    count_idx = i
-
-            if ip_idx == -1 or count_idx == -1:
-                print("警告：在回傳資料中找不到必要的欄位")
-                return {}
-
-            # 建立 IP 和計數的對應字典
-            ip_counts = {}
-            for row in result_json['rows']:
-                ip = row[ip_idx]
-                count = row[count_idx]
-                ip_counts[ip] = count
-
-            return ip_counts
-
-        except json.JSONDecodeError:
-            print("警告：無法解析 JSON 格式的回傳資料")
-            return {}
-        except Exception as e:
-            print(f"警告：解析資料時發生錯誤: {str(e)}")
+    def extract_ip_counts(self, column_names: List[str], rows: List[list]) -> Dict[str, int]:
+        """Map each destination IP to its count using the SQL column names."""
+        # 找出 IP 和 count 的欄位索引
+        if 'destination.ip' not in column_names or 'count' not in column_names:
+            print("警告：在回傳資料中找不到必要的欄位")
             return {}
+        ip_idx = column_names.index('destination.ip')
+        count_idx = column_names.index('count')
+
+        # 建立 IP 和計數的對應字典
+        return {row[ip_idx]: row[count_idx] for row in rows}
 
     def compare_days(self, prev_result: Dict[str, int], 
                      curr_result: Dict[str, int]) -> Dict[str, dict]:
@@ -139,7 +163,8 @@ class ElasticsearchQueryClient:
             "maintained": maintained_ips
         }
 
-    def save_daily_results(self, results: dict, date_str: str, output_dir: str = "query_results"):
+    def save_daily_results(self, results: dict, date_str: str, output_dir: str = "query_results",
+                           site: Optional[str] = None, sampler: Optional[Sampler] = None):
         """Save query results for a specific day in JSON format."""
         daily_dir = os.path.join(output_dir, date_str)
         os.makedirs(daily_dir, exist_ok=True)
@@ -147,37 +172,100 @@ class ElasticsearchQueryClient:
         for ip, result in results.items():
             if result:
                 try:
-                    # 嘗試解析原始 JSON 字串以確保它是有效的
-                    raw_json = json.loads(result)
+                    # 只解碼一次，同時取得連線次數與要保存的原始結果
+                    decoded = self.decode_query_result(result)
+                    if decoded is None:
+                        continue
+                    columns, rows = decoded
 
                     # 準備儲存的資料結構
                     parsed_data = {
                         "metadata": {
                             "source_ip": ip,
                             "query_date": date_str,
-                            "timestamp": datetime.now().isoformat()
+                            "timestamp": datetime.now().isoformat(),
+                            "site": site,
+                            **(sampler.metadata() if sampler else {})
                         },
-                        "data": self.parse_query_result(result),
-                        "raw_result": raw_json  # 儲存解析後的 JSON 物件
+                        "data": self.extract_ip_counts([column['name'] for column in columns], rows),
+                        "raw_result": {"columns": columns, "rows": rows}  # 儲存解析後的 SQL 結果
                     }
 
                     # 儲存為 JSON 檔案
                     filename = os.path.join(daily_dir, f"{ip}.json")
                     with open(filename, "w", encoding="utf-8") as f:
-                        json.dump(parsed_data, f, ensure_ascii=False, indent=2)
+                        fast_json.dump(parsed_data, f)
 
-                except json.JSONDecodeError as e:
+                except fast_json.JSONDecodeError as e:
                     print(f"警告：IP {ip} 的查詢結果不是有效的 JSON 格式: {str(e)}")
                     continue
                 except Exception as e:
                     print(f"警告：處理 IP {ip} 的查詢結果時發生錯誤: {str(e)}")
                     continue
 
-    def generate_csv_report(self, output_dir: str = "query_results") -> str:
+    def write_comparison_rows(self, writer, date1: str, date2: str):
+        """Write the comparison rows of one date pair to a CSV writer."""
+        date_range = f"{date1} to {date2}"
+
+        # 對每個來源 IP 進行分析
+        for source_ip in self.daily_ip_data[date1].keys():
+            prev_results = self.daily_ip_data[date1].get(source_ip, {})
+            curr_results = self.daily_ip_data[date2].get(source_ip, {})
+
+            comparison = self.compare_days(prev_results, curr_results)
+
+            # 處理新增的 IP
+            for ip, count in comparison["added"].items():
+                writer.writerow({
+                    "比較日期區間": date_range,
+                    "來源IP": source_ip,
+                    "目標IP": ip,
+                    "IP狀態": "新增",
+                    "前一天連線次數": 0,
+                    "當天連線次數": count,
+                    "連線次數變化": count,
+                    "變化趨勢": "新增",
+                    "變化幅度": count
+                })
+
+            # 處理移除的 IP
+            for ip, count in comparison["removed"].items():
+                writer.writerow({
+                    "比較日期區間": date_range,
+                    "來源IP": source_ip,
+                    "目標IP": ip,
+                    "IP狀態": "移除",
+                    "前一天連線次數": count,
+                    "當天連線次數": 0,
+                    "連線次數變化": -count,
+                    "變化趨勢": "移除",
+                    "變化幅度": count
+                })
+
+            # 處理維持連線的 IP
+            for ip, (prev_count, curr_count) in comparison["maintained"].items():
+                change = curr_count - prev_count
+                trend = "增加" if change > 0 else "減少" if change < 0 else "不變"
+
+                writer.writerow({
+                    "比較日期區間": date_range,
+                    "來源IP": source_ip,
+                    "目標IP": ip,
+                    "IP狀態": "維持",
+                    "前一天連線次數": prev_count,
+                    "當天連線次數": curr_count,
+                    "連線次數變化": change,
+                    "變化趨勢": trend,
+                    "變化幅度": abs(change)
+                })
+
+    def generate_csv_report(self, output_dir: str = "query_results",
+                            incremental: bool = False) -> str:
         """Generate and save the IP comparison report in CSV format.
 
         Args:
             output_dir: Directory to save the report
+            incremental: Append only date pairs not yet in the rolling report
 
         Returns:
             str: Path to the generated CSV report file
@@ -187,11 +275,6 @@ class ElasticsearchQueryClient:
 
         report_dir = os.path.join(output_dir, "comparison_reports")
         os.makedirs(report_dir, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-        # 設定 CSV 檔案路徑
-        csv_report_file = os.path.join(
-            report_dir, f"ip_traffic_report_{timestamp}.csv")
 
         # 定義 CSV 欄位
         fieldnames = [
@@ -208,66 +291,36 @@ class ElasticsearchQueryClient:
 
         dates = sorted(self.daily_ip_data.keys())
 
-        with open(csv_report_file, 'w', newline='', encoding='utf-8') as csvfile:
+        if incremental:
+            # 滾動報告：只計算尚未輸出的日期組合並追加
+            csv_report_file = os.path.join(report_dir, "ip_traffic_report.csv")
+            state = ReportState(csv_report_file)
+            # 補收集中間日期後，原本的比較組合已不相鄰，先從報告移除
+            state.remove_stale_pairs(dates)
+            pairs = state.pending_pairs(dates)
+            write_header = not os.path.exists(csv_report_file)
+            mode = 'a'
+        else:
+            # 設定 CSV 檔案路徑
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            csv_report_file = os.path.join(
+                report_dir, f"ip_traffic_report_{timestamp}.csv")
+            pairs = [(dates[i], dates[i + 1]) for i in range(len(dates) - 1)]
+            write_header = True
+            mode = 'w'
+
+        with open(csv_report_file, mode, newline='', encoding='utf-8') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+            if write_header:
+                writer.writeheader()
 
             # 比較每兩天的數據
-            for i in range(len(dates) - 1):
-                date1, date2 = dates[i], dates[i + 1]
-                date_range = f"{date1} to {date2}"
-
-                # 對每個來源 IP 進行分析
-                for source_ip in self.daily_ip_data[date1].keys():
-                    prev_results = self.daily_ip_data[date1].get(source_ip, {})
-                    curr_results = self.daily_ip_data[date2].get(source_ip, {})
-
-                    comparison = self.compare_days(prev_results, curr_results)
-
-                    # 處理新增的 IP
-                    for ip, count in comparison["added"].items():
-                        writer.writerow({
-                            "比較日期區間": date_range,
-                            "來源IP": source_ip,
-                            "目標IP": ip,
-                            "IP狀態": "新增",
-                            "前一天連線次數": 0,
-                            "當天連線次數": count,
-                            "連線次數變化": count,
-                            "變化趨勢": "新增",
-                            "變化幅度": count
-                        })
-
-                    # 處理移除的 IP
-                    for ip, count in comparison["removed"].items():
-                        writer.writerow({
-                            "比較日期區間": date_range,
-                            "來源IP": source_ip,
-                            "目標IP": ip,
-                            "IP狀態": "移除",
-                            "前一天連線次數": count,
-                            "當天連線次數": 0,
-                            "連線次數變化": -count,
-                            "變化趨勢": "移除",
-                            "變化幅度": count
-                        })
-
-                    # 處理維持連線的 IP
-                    for ip, (prev_count, curr_count) in comparison["maintained"].items():
-                        change = curr_count - prev_count
-                        trend = "增加" if change > 0 else "減少" if change < 0 else "不變"
-
-                        writer.writerow({
-                            "比較日期區間": date_range,
-                            "來源IP": source_ip,
-                            "目標IP": ip,
-                            "IP狀態": "維持",
-                            "前一天連線次數": prev_count,
-                            "當天連線次數": curr_count,
-                            "連線次數變化": change,
-                            "變化趨勢": trend,
-                            "變化幅度": abs(change)
-                        })
+            for date1, date2 in pairs:
+                self.write_comparison_rows(writer, date1, date2)
+
+        if incremental:
+            state.mark_done(pairs)
+            print(f"新增 {len(pairs)} 組日期比較")
 
         print(f"CSV 報告已儲存到: {csv_report_file}")
         return csv_report_file
@@ -290,7 +343,7 @@ class ElasticsearchQueryClient:
             try:
                 # 檢查文件是否可以正常讀取且包含有效數據
                 with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                    data = fast_json.load(f)
                     # 檢查文件內容是否完整
                     if all(key in data for key in ['metadata', 'data']):
                         # 將已存在的數據加載到內存中
@@ -299,31 +352,64 @@ class ElasticsearchQueryClient:
                         self.daily_ip_data[date_str][ip] = data['data']
                         print(f"已找到 {date_str} 日期 IP {ip} 的現有查詢結果")
                         return True
-            except (json.JSONDecodeError, KeyError):
+            except (fast_json.JSONDecodeError, KeyError):
                 print(f"警告：{date_str} 日期 IP {ip} 的現有查詢結果無效，將重新查詢")
                 return False
         return False
     
     def collect_traffic_data(self, start_date: str, end_date: str,
-                             ip_list_file: str, output_dir: str):
-        """Collect and process traffic data."""
+                             ip_list_file: Optional[str], output_dir: str,
+                             shard: Optional[SiteShard] = None,
+                             discovery: Optional[DeviceDiscovery] = None,
+                             sampler: Optional[Sampler] = None):
+        """Collect and process traffic data.
+
+        When a shard is given, only its device range is queried and results are
+        written to the site partition, to be combined later by merge_site_partitions.
+        When discovery is given, each day queries only the devices active on that
+        day; the IP list file is then optional and used as a fallback.
+        When a sampler is given, only the sampled days or devices are queried.
+        """
         try:
             # 讀取 IP 列表
-            ip_list = self.read_ip_list(ip_list_file)
+            ip_list = self.read_ip_list(ip_list_file) if ip_list_file else []
             print(f"已讀取 {len(ip_list)} 個 IP 地址")
 
+            site = None
+            if shard:
+                site = shard.site
+                output_dir = shard.partition_dir(output_dir)
+                print(f"站點 {site} 分片 {shard.shard_index + 1}/{shard.shard_count}")
+
             # 為每一天進行查詢
             for start_time, end_time in self.generate_date_ranges(start_date, end_date):
                 date_str = start_time[:10]
                 print(f"\n處理日期: {date_str}")
 
+                if sampler and sampler.unit == "day" and not sampler.keep(date_str, ""):
+                    print(f"未抽中日期 {date_str}，略過")
+                    continue
+
+                day_ips = ip_list
+                if discovery:
+                    active_ips = discovery.discover("traffic", start_time, end_time)
+                    # 探索失敗時退回靜態 IP 列表
+                    if active_ips is not None:
+                        day_ips = active_ips
+                        print(f"探索到 {len(day_ips)} 個活躍設備")
+                if shard:
+                    day_ips = shard.select(day_ips)
+                    print(f"本分片負責 {len(day_ips)} 個 IP")
+                if sampler:
+                    day_ips = [ip for ip in day_ips if sampler.keep(date_str, ip)]
+
                 # 確保輸出目錄存在
                 daily_dir = os.path.join(output_dir, date_str)
                 os.makedirs(daily_dir, exist_ok=True)
 
                 # 對每個 IP 進行查詢
                 daily_results = {}
-                for ip in ip_list:
+                for ip in day_ips:
                     # 檢查是否已有查詢結果
                     if not self.check_existing_results(date_str, ip, output_dir):
                         print(f"正在查詢 IP: {ip}")
@@ -334,7 +420,7 @@ class ElasticsearchQueryClient:
                 # 儲存查詢結果
                 if daily_results:
                     self.save_daily_results(
-                        daily_results, date_str, output_dir)
+                        daily_results, date_str, output_dir, site, sampler)
 
             print("\n資料收集完成")
 
@@ -356,12 +442,25 @@ def main():
     OUTPUT_DIR = "elastic_query_results"
     START_DATE = "2024-10-13"
     END_DATE = "2024-10-19"
+    RETENTION_DAYS = None  # 例如 90：超過保留期限的日期不送出查詢
+    SUMMARY_INDEX = None  # 例如 "milix-sessions-daily"：讀取 setup_es_transforms 建立的摘要索引
+    DEVICE_SUBNET = None  # 例如 "192.168.1.0/24"：自動探索活躍設備，取代 ip_list.txt
+    SAMPLE_PROBABILITY = 1.0  # 小於 1 時啟用近似模式，只查詢抽中的日期或設備
+    SAMPLE_UNIT = "device"  # 流量趨勢報告只支援依設備抽樣
 
     try:
+        # 多站點部署時由 MILIX_SITE 等環境變數指定分片
+        shard = SiteShard.from_env()
         client = ElasticsearchQueryClient(
-            ELASTICSEARCH_HOST, USERNAME, PASSWORD)
+            ELASTICSEARCH_HOST, USERNAME, PASSWORD, RETENTION_DAYS, SUMMARY_INDEX)
+        discovery = None
+        if DEVICE_SUBNET:
+            discovery = DeviceDiscovery(
+                ELASTICSEARCH_HOST, client.auth, DEVICE_SUBNET,
+                retention_days=RETENTION_DAYS)
+        sampler = Sampler(SAMPLE_PROBABILITY, SAMPLE_UNIT) if SAMPLE_PROBABILITY < 1 else None
         client.collect_traffic_data(
-            START_DATE, END_DATE, IP_LIST_FILE, OUTPUT_DIR)
+            START_DATE, END_DATE, IP_LIST_FILE, OUTPUT_DIR, shard, discovery, sampler)
         print("收集完成！")
     except Exception as e:
         print(f"執行過程中發生錯誤: {str(e)}")
@@ -0,0 +1,302 @@
+import calendar
+import os
+import shutil
+import sys
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import fast_json
+from sampling import inclusion_probability
+from site_shard import is_date_dir, split_device_stem
+
+# 彙總資料存放的子目錄，例如 <base>/_rollups/weekly/2024-10-07..2024-10-13/<ip>.json
+ROLLUP_DIR = "_rollups"
+PERIODS = ("weekly", "monthly")
+
+
+def period_label(start: date, end: date) -> str:
+    """彙總期間的標籤，可依字串排序且與每日目錄名稱相容"""
+    return f"{start.isoformat()}..{end.isoformat()}"
+
+
+def period_bounds(label: str) -> Tuple[date, date]:
+    """解析每日（YYYY-MM-DD）或彙總期間（start..end）標籤的起訖日期"""
+    start, _, end = label.partition("..")
+    start_day = datetime.strptime(start, "%Y-%m-%d").date()
+    end_day = datetime.strptime(end, "%Y-%m-%d").date() if end else start_day
+    return start_day, end_day
+
+
+def month_bounds(day: date) -> Tuple[date, date]:
+    """日期所屬月份的第一天與最後一天"""
+    month_start = day.replace(day=1)
+    return month_start, month_start.replace(
+        day=calendar.monthrange(month_start.year, month_start.month)[1])
+
+
+def list_periods(base_dir: str) -> Dict[str, str]:
+    """列出收集目錄中的每日資料與彙總資料，回傳 {標籤: 目錄路徑}"""
+    periods = {}
+    if not os.path.isdir(base_dir):
+        return periods
+
+    for name in os.listdir(base_dir):
+        path = os.path.join(base_dir, name)
+        if is_date_dir(name) and os.path.isdir(path):
+            periods[name] = path
+
+    for period in PERIODS:
+        period_root = os.path.join(base_dir, ROLLUP_DIR, period)
+        if not os.path.isdir(period_root):
+            continue
+        for name in os.listdir(period_root):
+            try:
+                period_bounds(name)
+            except ValueError:
+                continue
+            periods[name] = os.path.join(period_root, name)
+    return periods
+
+
+class RetentionCompactor:
+    """將舊的每日收集資料彙總為每週、再彙總為每月的資料，並刪除原始每日檔案"""
+    def __init__(self, weekly_after_days: int = 30, monthly_after_days: int = 180,
+                 today: Optional[date] = None):
+        """
+        Args:
+            weekly_after_days: 超過此天數的完整週彙總為每週資料
+            monthly_after_days: 超過此天數的完整月彙總為每月資料
+            today: 計算保留期限的基準日（預設為今天）
+        """
+        if monthly_after_days < weekly_after_days:
+            raise ValueError("monthly_after_days 不可小於 weekly_after_days")
+        self.weekly_after_days = weekly_after_days
+        self.monthly_after_days = monthly_after_days
+        self.today = today or date.today()
+
+    def compact(self, base_dir: str, kind: str) -> None:
+        """彙總單一收集目錄
+
+        Args:
+            base_dir: 收集器輸出目錄
+            kind: "traffic"（elastic_query_results）或 "dns"（dns_query_results）
+        """
+        if kind not in ("traffic", "dns"):
+            raise ValueError(f"未知的資料類型: {kind}")
+
+        # 每日 -> 每週：只彙總整週都超過保留期限的資料；
+        # 跨月的週在月份交界處切開，每段只屬於單一月份
+        week_cutoff = self.today - timedelta(days=self.weekly_after_days)
+        weekly_groups = defaultdict(list)
+        for label, path in list_periods(base_dir).items():
+            if ".." in label:
+                continue
+            day = period_bounds(label)[0]
+            week_start = day - timedelta(days=day.weekday())
+            week_end = week_start + timedelta(days=6)
+            if week_end < week_cutoff:
+                month_start, month_end = month_bounds(day)
+                weekly_groups[(max(week_start, month_start), min(week_end, month_end))].append(path)
+
+        for (start, end), sources in sorted(weekly_groups.items()):
+            self.rollup(base_dir, kind, "weekly", start, end, sources)
+
+        # 每週 -> 每月：每週資料已在月份交界處切開，整段都落在同一個月
+        month_cutoff = self.today - timedelta(days=self.monthly_after_days)
+        weekly_root = os.path.join(base_dir, ROLLUP_DIR, "weekly")
+        monthly_groups = defaultdict(list)
+        if os.path.isdir(weekly_root):
+            for label in os.listdir(weekly_root):
+                try:
+                    week_start, week_end = period_bounds(label)
+                except ValueError:
+                    continue
+                month_start, month_end = month_bounds(week_start)
+                if week_end > month_end:
+                    # 舊版產生的跨月週資料無法拆分，保留為每週資料以免月份範圍錯誤
+                    print(f"警告：每週資料 {label} 跨越月份，未彙總為每月資料")
+                    continue
+                if month_end < month_cutoff:
+                    monthly_groups[(month_start, month_end)].append(
+                        os.path.join(weekly_root, label))
+
+        for (start, end), sources in sorted(monthly_groups.items()):
+            self.rollup(base_dir, kind, "monthly", start, end, sources)
+
+    def rollup(self, base_dir: str, kind: str, period: str,
+               start: date, end: date, sources: List[str]) -> None:
+        """將多個來源目錄合併為單一彙總目錄，完成後刪除來源目錄"""
+        target_dir = os.path.join(base_dir, ROLLUP_DIR, period, period_label(start, end))
+        sampling = self.group_sampling(sources + [target_dir])
+        if sampling is None:
+            print(f"略過 {period_label(start, end)}：來源資料的抽樣設定無法合併，保留原始資料")
+            return
+        os.makedirs(target_dir, exist_ok=True)
+        print(f"彙總 {len(sources)} 個目錄到 {target_dir}")
+
+        # 檔名為 <ip> 或多站點合併後的 <site>__<ip>
+        stems = sorted({name[:-5] for source in sources
+                        for name in os.listdir(source) if name.endswith('.json')})
+        for stem in stems:
+            site, ip = split_device_stem(stem)
+            target_file = os.path.join(target_dir, f"{stem}.json")
+            existing = self.load_json(target_file) if os.path.exists(target_file) else None
+            inputs = [(self.source_label(source), self.load_json(os.path.join(source, f"{stem}.json")))
+                      for source in sources if os.path.exists(os.path.join(source, f"{stem}.json"))]
+
+            if kind == "traffic":
+                merged = self.merge_traffic(ip, existing, inputs)
+            else:
+                merged = self.merge_dns(ip, existing, inputs)
+            if site:
+                merged['metadata']['site'] = site
+            merged['metadata'].update(sampling)
+            merged['metadata'].update({
+                'period': period,
+                'start': start.isoformat(),
+                'end': end.isoformat()
+            })
+            self.write_json(target_file, merged)
+
+        for source in sources:
+            shutil.rmtree(source)
+
+    def group_sampling(self, dirs: List[str]) -> Optional[Dict]:
+        """來源資料共同的抽樣設定，寫入彙總資料的 metadata
+
+        分析器依檔案記錄的抽樣機率估計總數，因此抽樣設定不同的資料不可合併；
+        依日期抽樣的每一天是獨立的抽樣單位，合併後無法計算誤差，也不彙總。
+        兩種情況皆回傳 None。
+        """
+        settings = set()
+        for directory in dirs:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.json'):
+                    data = self.load_json(os.path.join(directory, name))
+                    if data:
+                        settings.add(inclusion_probability(data.get('metadata')))
+
+        if len(settings) > 1:
+            return None
+        probability, unit = settings.pop() if settings else (1.0, None)
+        if unit == "day":
+            return None
+        if unit is None:
+            return {}
+        return {"sample_probability": probability, "sample_unit": unit}
+
+    @staticmethod
+    def source_label(source: str) -> str:
+        """來源目錄的期間標籤"""
+        return os.path.basename(os.path.normpath(source))
+
+    @staticmethod
+    def load_json(file_path: str) -> Optional[Dict]:
+        """讀取 JSON 檔案，失敗時回傳 None"""
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return fast_json.load(f)
+        except (fast_json.JSONDecodeError, OSError) as e:
+            print(f"警告：無法讀取 {file_path}: {str(e)}")
+            return None
+
+    @staticmethod
+    def write_json(file_path: str, data: Dict) -> None:
+        """以暫存檔寫入後取代，避免中斷時留下不完整的檔案"""
+        tmp_file = f"{file_path}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            fast_json.dump(data, f)
+        os.replace(tmp_file, file_path)
+
+    @staticmethod
+    def covered_days(label: str, data: Dict) -> List[str]:
+        """來源資料涵蓋的日期（彙總資料記錄於 metadata.days）"""
+        days = data.get('metadata', {}).get('days')
+        return days if days else [period_bounds(label)[0].isoformat()]
+
+    def merge_traffic(self, ip: str, existing: Optional[Dict],
+                      inputs: List[Tuple[str, Optional[Dict]]]) -> Dict:
+        """合併流量資料：加總連線次數並保留首次/最後出現日期"""
+        merged = existing or {'metadata': {'source_ip': ip, 'days': []},
+                              'data': {}, 'first_seen': {}, 'last_seen': {}}
+        days = set(merged['metadata'].get('days', []))
+
+        for label, data in inputs:
+            if not data or 'data' not in data:
+                continue
+            source_days = self.covered_days(label, data)
+            # 中斷後重跑時略過已彙總的日期，避免重複加總
+            if days.issuperset(source_days):
+                continue
+            days.update(source_days)
+            first_seen = data.get('first_seen', {})
+            last_seen = data.get('last_seen', {})
+            for dst_ip, count in data['data'].items():
+                merged['data'][dst_ip] = merged['data'].get(dst_ip, 0) + count
+                first = first_seen.get(dst_ip, min(source_days))
+                last = last_seen.get(dst_ip, max(source_days))
+                merged['first_seen'][dst_ip] = min(merged['first_seen'].get(dst_ip, first), first)
+                merged['last_seen'][dst_ip] = max(merged['last_seen'].get(dst_ip, last), last)
+
+        merged['metadata']['days'] = sorted(days)
+        return merged
+
+    def merge_dns(self, ip: str, existing: Optional[Dict],
+                  inputs: List[Tuple[str, Optional[Dict]]]) -> Dict:
+        """合併 DNS 資料：(查詢名稱, 回應 IP) 取聯集並保留首次/最後出現日期"""
+        pairs = {}
+        days = set()
+        if existing:
+            days.update(existing['metadata'].get('days', []))
+            for record in existing.get('records', []):
+                for answer_ip in record['answer_ips']:
+                    pairs[(record['question_name'], answer_ip)] = [
+                        record['first_seen'], record['last_seen']]
+
+        for label, data in inputs:
+            if not data or 'records' not in data:
+                continue
+            source_days = self.covered_days(label, data)
+            if days.issuperset(source_days):
+                continue
+            days.update(source_days)
+            for record in data['records']:
+                question_name = record['question_name'].rstrip('.')
+                first = record.get('first_seen', min(source_days))
+                last = record.get('last_seen', max(source_days))
+                for answer_ip in record['answer_ips']:
+                    seen = pairs.setdefault((question_name, answer_ip), [first, last])
+                    seen[0] = min(seen[0], first)
+                    seen[1] = max(seen[1], last)
+
+        records = [{
+            'timestamp': f"{first}T00:00:00Z",
+            'dst_ip': ip,
+            'question_name': question_name,
+            'answer_ips': [answer_ip],
+            'first_seen': first,
+            'last_seen': last
+        } for (question_name, answer_ip), (first, last) in sorted(pairs.items())]
+        return {'metadata': {'source_ip': ip, 'days': sorted(days)}, 'records': records}
+
+
+def main():
+    # 固定配置
+    WEEKLY_AFTER_DAYS = 30
+    MONTHLY_AFTER_DAYS = 180
+
+    compactor = RetentionCompactor(WEEKLY_AFTER_DAYS, MONTHLY_AFTER_DAYS)
+    try:
+        compactor.compact("elastic_query_results", "traffic")
+        compactor.compact("dns_query_results", "dns")
+        print("彙總完成")
+    except Exception as e:
+        print(f"彙總過程中發生錯誤: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
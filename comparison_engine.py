@@ -0,0 +1,153 @@
+import csv
+import heapq
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from site_shard import is_date_dir
+
+# 每日資料的排序陣列：[(來源IP, 目標IP, 連線次數), ...]，依 (來源IP, 目標IP) 排序
+DayArray = List[Tuple[str, str, float]]
+
+LAG_FIELDNAMES = [
+    "比較類型",
+    "比較日期",
+    "基準日期",
+    "來源IP",
+    "目標IP",
+    "IP狀態",
+    "基準連線次數",
+    "當天連線次數",
+    "連線次數變化",
+    "變化趨勢",
+    "變化幅度"
+]
+
+
+def build_day_array(day_data: Dict[str, Dict[str, int]]) -> DayArray:
+    """將 {來源IP: {目標IP: 次數}} 轉為排序陣列"""
+    return sorted((source_ip, dst_ip, count)
+                  for source_ip, counts in day_data.items()
+                  for dst_ip, count in counts.items())
+
+
+def merge_mean(arrays: List[DayArray]) -> DayArray:
+    """以 k-way merge 計算多個排序陣列的平均（缺少的日期視為 0）"""
+    if len(arrays) == 1:
+        return arrays[0]
+    merged = heapq.merge(*arrays, key=lambda item: (item[0], item[1]))
+    return [(source_ip, dst_ip, sum(item[2] for item in group) / len(arrays))
+            for (source_ip, dst_ip), group in groupby(merged, key=lambda item: (item[0], item[1]))]
+
+
+def merge_join(baseline: DayArray, current: DayArray) -> Iterator[Tuple[str, str, float, float]]:
+    """對兩個排序陣列做 full outer merge join，回傳 (來源IP, 目標IP, 基準次數, 當天次數)"""
+    i, j = 0, 0
+    while i < len(baseline) or j < len(current):
+        base_key = baseline[i][:2] if i < len(baseline) else None
+        curr_key = current[j][:2] if j < len(current) else None
+        if curr_key is None or (base_key is not None and base_key < curr_key):
+            yield base_key[0], base_key[1], baseline[i][2], 0
+            i += 1
+        elif base_key is None or curr_key < base_key:
+            yield curr_key[0], curr_key[1], 0, current[j][2]
+            j += 1
+        else:
+            yield base_key[0], base_key[1], baseline[i][2], current[j][2]
+            i += 1
+            j += 1
+
+
+class LagComparisonEngine:
+    """以預先排序的每日陣列計算任意間隔的比較
+
+    支援的比較類型：
+        lag:N       與 N 天前比較（lag:1 為前一天、lag:7 為上週同一天）
+        weekday:N   與前 N 週同一星期幾的平均比較
+        trailing:N  與前 N 天的平均比較
+    """
+    def __init__(self, daily_ip_data: Dict[str, Dict[str, Dict[str, int]]]):
+        # 每天只建立一次排序陣列；彙總期間（start..end）沒有單日意義，不納入
+        self.arrays: Dict[str, DayArray] = {
+            date_str: build_day_array(day_data)
+            for date_str, day_data in daily_ip_data.items() if is_date_dir(date_str)
+        }
+
+    @staticmethod
+    def baseline_dates(date_str: str, lag: str) -> List[str]:
+        """依比較類型計算基準日期"""
+        kind, _, value = lag.partition(":")
+        try:
+            n = int(value)
+        except ValueError:
+            raise ValueError(f"無效的比較類型: {lag}")
+        if n < 1:
+            raise ValueError(f"無效的比較類型: {lag}")
+
+        day = datetime.strptime(date_str, "%Y-%m-%d")
+        if kind == "lag":
+            offsets = [n]
+        elif kind == "weekday":
+            offsets = [7 * week for week in range(1, n + 1)]
+        elif kind == "trailing":
+            offsets = list(range(1, n + 1))
+        else:
+            raise ValueError(f"無效的比較類型: {lag}")
+        return [(day - timedelta(days=offset)).strftime("%Y-%m-%d") for offset in offsets]
+
+    def baseline(self, date_str: str, lag: str) -> Optional[Tuple[List[str], DayArray]]:
+        """取得基準陣列，只使用已收集的日期，全部缺少時回傳 None"""
+        dates = [d for d in self.baseline_dates(date_str, lag) if d in self.arrays]
+        if not dates:
+            return None
+        return dates, merge_mean([self.arrays[d] for d in dates])
+
+    def compare(self, lags: List[str]) -> Iterator[Dict]:
+        """單次掃描所有日期，輸出每種比較類型的結果列"""
+        for lag in lags:
+            # 提前驗證比較類型
+            self.baseline_dates("2000-01-01", lag)
+
+        for date_str in sorted(self.arrays):
+            current = self.arrays[date_str]
+            for lag in lags:
+                baseline = self.baseline(date_str, lag)
+                if baseline is None:
+                    continue
+                baseline_dates, baseline_array = baseline
+                baseline_label = (baseline_dates[0] if len(baseline_dates) == 1
+                                  else f"{baseline_dates[-1]}~{baseline_dates[0]} 平均")
+
+                for source_ip, dst_ip, prev_count, curr_count in merge_join(baseline_array, current):
+                    change = curr_count - prev_count
+                    if prev_count == 0:
+                        status = trend = "新增"
+                    elif curr_count == 0:
+                        status = trend = "移除"
+                    else:
+                        status = "維持"
+                        trend = "增加" if change > 0 else "減少" if change < 0 else "不變"
+                    yield {
+                        "比較類型": lag,
+                        "比較日期": date_str,
+                        "基準日期": baseline_label,
+                        "來源IP": source_ip,
+                        "目標IP": dst_ip,
+                        "IP狀態": status,
+                        "基準連線次數": round(prev_count, 2),
+                        "當天連線次數": curr_count,
+                        "連線次數變化": round(change, 2),
+                        "變化趨勢": trend,
+                        "變化幅度": round(abs(change), 2)
+                    }
+
+    def write_csv(self, lags: List[str], filename: str) -> int:
+        """將所有比較結果寫入 CSV，回傳寫入筆數"""
+        rows = 0
+        with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=LAG_FIELDNAMES)
+            writer.writeheader()
+            for row in self.compare(lags):
+                writer.writerow(row)
+                rows += 1
+        return rows
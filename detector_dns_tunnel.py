@@ -0,0 +1,194 @@
+import csv
+import math
+import os
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+# 唯一子網域估計使用的位元數（linear counting），每個設備固定佔用 BITMAP_BITS / 8 bytes
+BITMAP_BITS = 1024
+# DNS 回應碼 NXDOMAIN
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+
+def label_entropy(text: str) -> float:
+    """計算字串的 Shannon entropy（bits / 字元）"""
+    if not text:
+        return 0.0
+    length = len(text)
+    return -sum(n / length * math.log2(n / length) for n in Counter(text).values())
+
+
+def split_subdomain(name: str) -> str:
+    """取出網域名稱中註冊網域以外的子網域部分，沒有子網域時回傳第一個 label"""
+    labels = name.rstrip('.').split('.')
+    if len(labels) > 2:
+        return '.'.join(labels[:-2])
+    return labels[0]
+
+
+class WindowStats:
+    """單一設備在單一時間窗內的累積特徵，僅保存計數與固定大小的位元圖"""
+    __slots__ = ('window', 'queries', 'total_length', 'max_length',
+                 'total_entropy', 'nxdomain', 'no_answer', 'bitmap')
+
+    def __init__(self, window: int):
+        self.window = window
+        self.queries = 0
+        self.total_length = 0
+        self.max_length = 0
+        self.total_entropy = 0.0
+        self.nxdomain = 0
+        self.no_answer = 0
+        self.bitmap = 0
+
+    def add(self, name: str, rcode: Optional[int], answer_count: Optional[int]) -> None:
+        """累加一筆 DNS 查詢
+
+        無回應以回應的 answer 數量判斷（任何類型的 answer 都算），只計入 Rcode 為 NOERROR 的回應；
+        缺少 Rcode 或 answer 數量的紀錄不計入。
+        """
+        subdomain = split_subdomain(name)
+        self.queries += 1
+        self.total_length += len(name)
+        self.max_length = max(self.max_length, len(name))
+        self.total_entropy += label_entropy(subdomain)
+        if rcode == RCODE_NXDOMAIN:
+            self.nxdomain += 1
+        if rcode == RCODE_NOERROR and answer_count == 0:
+            self.no_answer += 1
+        self.bitmap |= 1 << (zlib.crc32(name.lower().encode()) % BITMAP_BITS)
+
+    def unique_names(self) -> float:
+        """以 linear counting 估計時間窗內的唯一查詢名稱數"""
+        empty = BITMAP_BITS - bin(self.bitmap).count('1')
+        if empty == 0:
+            return float(BITMAP_BITS * math.log(BITMAP_BITS))
+        return BITMAP_BITS * math.log(BITMAP_BITS / empty)
+
+
+class DNSTunnelDetector:
+    """單次掃描的 DNS tunneling / DGA 偵測器
+
+    依時間排序逐筆餵入 DNS 紀錄，每個設備只保留目前時間窗的統計，
+    時間窗結束時計算特徵並判斷是否告警，可在收集時同步執行。
+    """
+    def __init__(self, window_seconds: int = 3600, min_queries: int = 20,
+                 max_avg_length: float = 52.0, max_avg_entropy: float = 3.8,
+                 max_unique_rate: float = 0.8, max_nxdomain_ratio: float = 0.5,
+                 max_query_rate: float = 1.0):
+        """
+        Args:
+            window_seconds: 時間窗長度（秒）
+            min_queries: 時間窗內查詢數低於此值時不判斷
+            max_avg_length: 平均名稱長度門檻
+            max_avg_entropy: 子網域平均 entropy 門檻
+            max_unique_rate: 唯一名稱比例門檻
+            max_nxdomain_ratio: NXDOMAIN 比例門檻
+            max_query_rate: 每秒查詢數門檻
+        """
+        self.window_seconds = window_seconds
+        self.min_queries = min_queries
+        self.max_avg_length = max_avg_length
+        self.max_avg_entropy = max_avg_entropy
+        self.max_unique_rate = max_unique_rate
+        self.max_nxdomain_ratio = max_nxdomain_ratio
+        self.max_query_rate = max_query_rate
+        self.current: Dict[str, WindowStats] = {}
+        self.alerts: List[Dict] = []
+
+    @staticmethod
+    def parse_timestamp(timestamp: str) -> int:
+        """將 dnsmonster 的 Timestamp 轉為 epoch 秒數（忽略小數部分）"""
+        parsed = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+        return int(parsed.replace(tzinfo=timezone.utc).timestamp())
+
+    def observe(self, record: Dict) -> Optional[Dict]:
+        """餵入一筆 collector 處理後的 DNS 紀錄，若前一個時間窗觸發告警則回傳該告警"""
+        name = record.get('question_name', '').rstrip('.')
+        if not name or name.endswith('.in-addr.arpa'):
+            return None
+
+        device = record['dst_ip']
+        window = self.parse_timestamp(record['timestamp']) // self.window_seconds
+        alert = None
+
+        stats = self.current.get(device)
+        if stats is None or stats.window != window:
+            if stats is not None:
+                alert = self.evaluate(device, stats)
+            stats = self.current[device] = WindowStats(window)
+
+        stats.add(name, record.get('rcode'), record.get('answer_count'))
+        return alert
+
+    def flush(self) -> List[Dict]:
+        """結束所有進行中的時間窗並回傳本次產生的告警"""
+        alerts = []
+        for device, stats in self.current.items():
+            alert = self.evaluate(device, stats)
+            if alert:
+                alerts.append(alert)
+        self.current = {}
+        return alerts
+
+    def features(self, stats: WindowStats) -> Dict[str, float]:
+        """計算時間窗的特徵值"""
+        queries = stats.queries
+        return {
+            'queries': queries,
+            'avg_length': stats.total_length / queries,
+            'max_length': stats.max_length,
+            'avg_entropy': stats.total_entropy / queries,
+            'unique_rate': min(stats.unique_names() / queries, 1.0),
+            'nxdomain_ratio': stats.nxdomain / queries,
+            'no_answer_ratio': stats.no_answer / queries,
+            'query_rate': queries / self.window_seconds,
+        }
+
+    def evaluate(self, device: str, stats: WindowStats) -> Optional[Dict]:
+        """判斷時間窗是否符合 tunneling 或 DGA 行為"""
+        if stats.queries < self.min_queries:
+            return None
+
+        feature = self.features(stats)
+        reasons = []
+        high_unique = feature['unique_rate'] >= self.max_unique_rate
+        if high_unique and (feature['avg_length'] >= self.max_avg_length
+                            or feature['avg_entropy'] >= self.max_avg_entropy):
+            reasons.append("tunneling")
+        if high_unique and max(feature['nxdomain_ratio'],
+                               feature['no_answer_ratio']) >= self.max_nxdomain_ratio:
+            reasons.append("DGA")
+        if feature['query_rate'] >= self.max_query_rate:
+            reasons.append("high query rate")
+        if not reasons:
+            return None
+
+        window_start = datetime.fromtimestamp(stats.window * self.window_seconds, timezone.utc)
+        alert = {
+            'Device_IP': device,
+            'Window_Start': window_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'Reasons': ",".join(reasons),
+            **{key: round(value, 3) for key, value in feature.items()}
+        }
+        self.alerts.append(alert)
+        print(f"告警：設備 {device} 於 {alert['Window_Start']} 疑似 {alert['Reasons']}")
+        return alert
+
+    def write_alerts(self, filename: str) -> None:
+        """將告警追加寫入 CSV 檔案"""
+        if not self.alerts:
+            print("沒有 DNS 異常告警")
+            return
+
+        write_header = not os.path.exists(filename)
+        with open(filename, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.alerts[0].keys()))
+            if write_header:
+                writer.writeheader()
+            writer.writerows(self.alerts)
+        print(f"DNS 異常告警已寫入 {filename}，共 {len(self.alerts)} 筆")
+        self.alerts = []
@@ -0,0 +1,166 @@
+import ipaddress
+import os
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+import fast_json
+from index_resolver import DailyIndexResolver
+
+
+class DeviceDiscovery:
+    """以單一聚合查詢找出時間範圍內 Wi-Fi 子網路中的活躍設備，取代手動維護的 ip_list.txt"""
+    def __init__(self, host: str, auth, subnet: str,
+                 cache_file: str = "device_discovery_cache.json",
+                 cache_ttl: int = 6 * 3600, max_devices: int = 1024,
+                 retention_days: Optional[int] = None):
+        """
+        Args:
+            host: Elasticsearch 位址
+            auth: requests 使用的驗證物件
+            subnet: 設備所在子網路，例如 192.168.1.0/24
+            cache_file: 探索結果快取檔
+            cache_ttl: 快取有效秒數
+            max_devices: terms 聚合回傳的最大設備數
+            retention_days: 資料保留天數，傳給索引解析器
+        """
+        self.host = host
+        self.auth = auth
+        self.network = ipaddress.ip_network(subnet, strict=False)
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.max_devices = max_devices
+        self.headers = {"Content-Type": "application/json"}
+        self.traffic_indices = DailyIndexResolver(host, auth, "arkime_sessions3*", retention_days)
+        self.dns_indices = DailyIndexResolver(host, auth, "pi-dnsmonster*", retention_days)
+        self.cache = self.load_cache()
+
+    def load_cache(self) -> Dict[str, Dict]:
+        """讀取探索結果快取"""
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return fast_json.load(f)
+        except (fast_json.JSONDecodeError, OSError) as e:
+            print(f"警告：無法讀取設備探索快取 {self.cache_file}: {str(e)}")
+            return {}
+
+    def save_cache(self) -> None:
+        """寫回探索結果快取，並移除已過期的項目"""
+        now = time.time()
+        self.cache = {key: entry for key, entry in self.cache.items()
+                      if entry.get('expires_at', 0) > now}
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            fast_json.dump(self.cache, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def subnet_regex(self) -> Optional[str]:
+        """將 IPv4 子網路轉為 Lucene 正規表示式，供字串型別的 IP 欄位過濾
+
+        例如 192.168.4.0/22 -> 192\\.168\\.(4|5|6|7)\\.[0-9]{1,3}；IPv6 回傳 None。
+        """
+        if self.network.version != 4:
+            return None
+        octets = str(self.network.network_address).split('.')
+        fixed, partial_bits = divmod(self.network.prefixlen, 8)
+        parts = octets[:fixed]
+        if fixed < 4:
+            if partial_bits:
+                low = int(octets[fixed])
+                high = low + 2 ** (8 - partial_bits) - 1
+                parts.append("(" + "|".join(str(value) for value in range(low, high + 1)) + ")")
+            else:
+                parts.append("[0-9]{1,3}")
+            parts += ["[0-9]{1,3}"] * (3 - fixed)
+        return "\\.".join(parts)
+
+    def build_query(self, ip_field: str, time_field: str,
+                    start_time: str, end_time: str, ip_type: bool) -> Dict:
+        """建立只回傳子網路內設備 IP 聚合結果的查詢"""
+        filters = [{"range": {time_field: {"gte": start_time, "lte": end_time}}}]
+        terms = {"field": ip_field, "size": self.max_devices}
+        if ip_type:
+            # ip 型別欄位可直接以 CIDR 過濾
+            filters.append({"term": {ip_field: str(self.network)}})
+        else:
+            # 字串欄位以正規表示式過濾，避免子網路外的熱門目的地佔滿聚合結果
+            pattern = self.subnet_regex()
+            if pattern:
+                filters.append({"regexp": {ip_field: pattern}})
+                terms["include"] = pattern
+        return {
+            "size": 0,
+            "query": {"bool": {"filter": filters}},
+            "aggs": {
+                "devices": {"terms": terms}
+            }
+        }
+
+    def query_devices(self, resolver: DailyIndexResolver, query: Dict,
+                      start_time: str, end_time: str) -> Optional[List[str]]:
+        """執行聚合查詢，回傳子網路內的設備 IP"""
+        indices = resolver.resolve(start_time, end_time)
+        if not indices:
+            return []
+
+        try:
+            response = requests.post(
+                f"{self.host}/{','.join(indices)}/_search?ignore_unavailable=true",
+                auth=self.auth,
+                headers=self.headers,
+                data=fast_json.dumps(query),
+                verify=False,
+                timeout=30
+            )
+            if response.status_code != 200:
+                print(f"設備探索查詢失敗，狀態碼：{response.status_code}")
+                print(f"回應內容：{response.text}")
+                return None
+
+            buckets = fast_json.loads(response.content).get('aggregations', {}).get('devices', {}).get('buckets', [])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"設備探索查詢時發生錯誤：{str(e)}")
+            return None
+
+        devices = []
+        for bucket in buckets:
+            try:
+                if ipaddress.ip_address(bucket['key']) in self.network:
+                    devices.append(bucket['key'])
+            except (ValueError, KeyError):
+                continue
+        if len(buckets) >= self.max_devices:
+            print(f"警告：活躍設備數達到上限 {self.max_devices}，結果可能不完整")
+        return sorted(devices, key=lambda ip: int(ipaddress.ip_address(ip)))
+
+    def discover(self, kind: str, start_time: str, end_time: str) -> Optional[List[str]]:
+        """回傳指定時間範圍內的活躍設備（優先使用快取）
+
+        Args:
+            kind: "traffic" 查詢 Arkime source.ip，"dns" 查詢 dnsmonster DstIP
+
+        Returns:
+            活躍設備 IP 列表，查詢失敗時回傳 None
+        """
+        cache_key = f"{kind}|{self.network}|{start_time}|{end_time}"
+        entry = self.cache.get(cache_key)
+        if entry and entry.get('expires_at', 0) > time.time():
+            return entry['ips']
+
+        if kind == "traffic":
+            query = self.build_query("source.ip", "@timestamp", start_time, end_time, True)
+            devices = self.query_devices(self.traffic_indices, query, start_time, end_time)
+        elif kind == "dns":
+            # DstIP 為字串欄位，以正規表示式於伺服器端過濾子網路，用戶端再確認一次
+            query = self.build_query("DstIP.keyword", "Timestamp", start_time, end_time, False)
+            devices = self.query_devices(self.dns_indices, query, start_time, end_time)
+        else:
+            raise ValueError(f"未知的探索類型: {kind}")
+
+        if devices is not None:
+            self.cache[cache_key] = {'ips': devices, 'expires_at': time.time() + self.cache_ttl}
+            self.save_cache()
+        return devices
@@ -0,0 +1,145 @@
+import json
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# JSON 序列化層：優先使用 orjson / msgspec，未安裝時退回標準函式庫 json。
+# msgspec 可用時，Elasticsearch SQL 回應（columns / rows）與 dnsmonster 搜尋結果
+# 直接解碼為具型別的結構，省去建立通用 dict 與逐層 .get 查找的成本。
+JSONDecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    BACKEND = "orjson"
+elif msgspec is not None:
+    BACKEND = "msgspec"
+else:
+    BACKEND = "json"
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """解析 JSON 字串或 bytes，格式錯誤時一律拋出 json.JSONDecodeError"""
+    if orjson is not None:
+        # orjson.JSONDecodeError 為 json.JSONDecodeError 的子類別
+        return orjson.loads(data)
+    if msgspec is not None:
+        try:
+            return msgspec.json.decode(data)
+        except msgspec.DecodeError as e:
+            raise JSONDecodeError(str(e), data if isinstance(data, str) else "", 0) from e
+    return json.loads(data)
+
+
+def load(f: IO) -> Any:
+    """從檔案物件讀取並解析 JSON"""
+    return loads(f.read())
+
+
+def dumps(obj: Any, indent: bool = False) -> str:
+    """序列化為 JSON 字串（保留非 ASCII 字元）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+    if msgspec is not None and not indent:
+        return msgspec.json.encode(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+
+def dump(obj: Any, f: IO, indent: bool = True) -> None:
+    """序列化並寫入以文字模式開啟的檔案"""
+    f.write(dumps(obj, indent))
+
+
+if msgspec is not None:
+    class SQLColumn(msgspec.Struct):
+        name: str
+        type: Optional[str] = None
+
+    class SQLResult(msgspec.Struct):
+        columns: List[SQLColumn]
+        rows: List[List[Any]]
+
+    class DNSQuestion(msgspec.Struct):
+        Name: str = ""
+
+    class DNSAnswer(msgspec.Struct):
+        # 只解碼 A 紀錄的位址；其他類型的 answer 仍會計入 answer 數量
+        A: Optional[str] = None
+
+    class DNSMsgHdr(msgspec.Struct):
+        Rcode: Optional[int] = None
+
+    class DNSMessage(msgspec.Struct):
+        Question: Optional[List[DNSQuestion]] = None
+        Answer: Optional[List[DNSAnswer]] = None
+        MsgHdr: Optional[DNSMsgHdr] = None
+
+    class DNSSource(msgspec.Struct):
+        Timestamp: str
+        DstIP: str
+        SrcIP: str
+        Protocol: str
+        DNS: Optional[DNSMessage] = None
+
+    class DNSHit(msgspec.Struct):
+        source: DNSSource = msgspec.field(name="_source")
+
+    class DNSHits(msgspec.Struct):
+        hits: List[DNSHit] = []
+
+    class DNSSearchResponse(msgspec.Struct):
+        hits: Optional[DNSHits] = None
+
+    _sql_decoder = msgspec.json.Decoder(SQLResult)
+    _dns_decoder = msgspec.json.Decoder(DNSSearchResponse)
+
+
+def decode_sql_result(data: Union[str, bytes]) -> Optional[Tuple[List[Dict], List[List[Any]]]]:
+    """以具型別結構解碼 _sql?format=json 回應，回傳 (欄位 [{name, type}], rows)
+
+    msgspec 不可用或格式不符時回傳 None，由呼叫端改用 loads 處理。
+    """
+    if msgspec is None:
+        return None
+    try:
+        result = _sql_decoder.decode(data)
+    except (msgspec.DecodeError, msgspec.ValidationError):
+        return None
+    return [{'name': column.name, 'type': column.type} for column in result.columns], result.rows
+
+
+def decode_dns_records(data: Union[str, bytes]) -> Optional[List[Dict]]:
+    """以具型別結構解碼 dnsmonster 搜尋回應，回傳與 process_dns_data 相同格式的紀錄
+
+    msgspec 不可用或格式不符時回傳 None，由呼叫端改用 loads 處理。
+    """
+    if msgspec is None:
+        return None
+    try:
+        response = _dns_decoder.decode(data)
+    except (msgspec.DecodeError, msgspec.ValidationError):
+        return None
+
+    records = []
+    for hit in (response.hits.hits if response.hits else []):
+        source = hit.source
+        dns = source.DNS
+        if dns is None:
+            continue
+        records.append({
+            'timestamp': source.Timestamp,
+            'dst_ip': source.DstIP,
+            'question_name': dns.Question[0].Name if dns.Question else "",
+            'answer_ips': [answer.A for answer in dns.Answer or [] if answer.A is not None],
+            'answer_count': len(dns.Answer or []),
+            'rcode': dns.MsgHdr.Rcode if dns.MsgHdr else None,
+            'src_ip': source.SrcIP,
+            'protocol': source.Protocol
+        })
+    return records
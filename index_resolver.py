@@ -0,0 +1,113 @@
+import re
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional
+
+import requests
+
+import fast_json
+
+# 索引名稱結尾的日期格式：
+#   Arkime rotateIndex=daily  -> arkime_sessions3-241013
+#   Arkime rotateIndex=hourly -> arkime_sessions3-241013h05
+#   其他常見格式              -> name-2024.10.13 / name-2024-10-13 / name-20241013
+_INDEX_DATE_PATTERNS = [
+    (re.compile(r"-(\d{4})[.-](\d{2})[.-](\d{2})$"), "%Y%m%d"),
+    (re.compile(r"-(\d{8})$"), "%Y%m%d"),
+    (re.compile(r"-(\d{6})(?:h\d{2})?$"), "%y%m%d"),
+]
+
+
+class DailyIndexResolver:
+    """將查詢時間範圍對應到實際存在的每日索引，避免萬用字元索引查詢所有分片"""
+    def __init__(self, host: str, auth, pattern: str,
+                 retention_days: Optional[int] = None, cache_ttl: int = 3600):
+        """
+        Args:
+            host: Elasticsearch 位址
+            auth: requests 使用的驗證物件
+            pattern: 索引樣式，例如 arkime_sessions3*
+            retention_days: 資料保留天數，超過此天數的查詢直接略過
+            cache_ttl: _cat/indices 清單的快取秒數
+        """
+        self.host = host
+        self.auth = auth
+        self.pattern = pattern
+        self.retention_days = retention_days
+        self.cache_ttl = cache_ttl
+        self._indices: Optional[List[str]] = None
+        self._fetched_at = 0.0
+
+    @staticmethod
+    def index_date(index_name: str) -> Optional[date]:
+        """從索引名稱解析日期，無法解析時回傳 None"""
+        for regex, fmt in _INDEX_DATE_PATTERNS:
+            match = regex.search(index_name)
+            if match:
+                try:
+                    return datetime.strptime("".join(match.groups()), fmt).date()
+                except ValueError:
+                    return None
+        return None
+
+    def list_indices(self) -> Optional[List[str]]:
+        """取得符合樣式的索引清單（含快取），查詢失敗時回傳 None"""
+        if self._indices is not None and time.monotonic() - self._fetched_at < self.cache_ttl:
+            return self._indices
+
+        try:
+            response = requests.get(
+                f"{self.host}/_cat/indices/{self.pattern}",
+                params={"format": "json", "h": "index"},
+                auth=self.auth,
+                verify=False,
+                timeout=30
+            )
+            if response.status_code != 200:
+                print(f"取得索引清單失敗，狀態碼：{response.status_code}")
+                return None
+            self._indices = sorted(item["index"] for item in fast_json.loads(response.content))
+            self._fetched_at = time.monotonic()
+            return self._indices
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"取得索引清單時發生錯誤：{e}")
+            return None
+
+    def invalidate(self):
+        """清除索引清單快取"""
+        self._indices = None
+
+    def resolve(self, start_time: str, end_time: str) -> List[str]:
+        """回傳可能包含 [start_time, end_time] 資料的索引
+
+        超過保留期限的時間範圍回傳空清單；無法取得索引清單時退回原本的索引樣式。
+        名稱中沒有日期的索引（例如未輪替的 dnsmonster 索引）一律保留。
+        Arkime 依封包時間決定每日索引，而查詢以寫入時間 @timestamp 過濾，
+        跨過午夜才寫入的 session 會留在前一天的索引，因此多保留前一天的索引。
+        """
+        start_dt = self._parse_time(start_time)
+        end_dt = self._parse_time(end_time)
+        # 結束時間為隔日 00:00:00 時不需要包含隔日的索引
+        last_day = (end_dt - timedelta(microseconds=1)).date() if end_dt > start_dt else start_dt.date()
+
+        if self.retention_days is not None:
+            oldest = datetime.now(timezone.utc).date() - timedelta(days=self.retention_days)
+            if last_day < oldest:
+                return []
+
+        indices = self.list_indices()
+        if indices is None:
+            return [self.pattern]
+
+        first_day = start_dt.date() - timedelta(days=1)
+        selected = []
+        for index_name in indices:
+            index_day = self.index_date(index_name)
+            if index_day is None or first_day <= index_day <= last_day:
+                selected.append(index_name)
+        return selected
+
+    @staticmethod
+    def _parse_time(value: str) -> datetime:
+        """解析 YYYY-MM-DDTHH:MM:SSZ 格式的時間"""
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,79 @@
+import csv
+import os
+from typing import List, Tuple
+
+import fast_json
+
+
+class ReportState:
+    """記錄滾動報告中已輸出的 (date1, date2) 比較組合"""
+    def __init__(self, report_file: str, label_field: str = "比較日期區間"):
+        self.report_file = report_file
+        self.label_field = label_field
+        self.state_file = f"{os.path.splitext(report_file)[0]}.state.json"
+        self.pairs = set()
+        self.load()
+
+    def load(self) -> None:
+        """讀取已完成的日期組合"""
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                self.pairs = {tuple(pair) for pair in fast_json.load(f).get('pairs', [])}
+        except (fast_json.JSONDecodeError, OSError) as e:
+            print(f"警告：無法讀取報告狀態 {self.state_file}: {str(e)}")
+            self.pairs = set()
+
+    def save(self) -> None:
+        """寫回狀態檔"""
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            fast_json.dump({'pairs': sorted(self.pairs)}, f)
+        os.replace(tmp_file, self.state_file)
+
+    def pending_pairs(self, dates: List[str]) -> List[Tuple[str, str]]:
+        """回傳相鄰日期中尚未輸出的組合"""
+        dates = sorted(dates)
+        return [(dates[i], dates[i + 1]) for i in range(len(dates) - 1)
+                if (dates[i], dates[i + 1]) not in self.pairs]
+
+    def stale_pairs(self, dates: List[str]) -> List[Tuple[str, str]]:
+        """已輸出但不再相鄰的組合，例如之後補收集了兩者之間的日期
+
+        只檢查兩個日期都仍存在的組合；已被彙總而移除的日期保留原本的比較結果。
+        """
+        dates = sorted(dates)
+        available = set(dates)
+        adjacent = set(zip(dates, dates[1:]))
+        return sorted(pair for pair in self.pairs
+                      if pair[0] in available and pair[1] in available and pair not in adjacent)
+
+    def remove_stale_pairs(self, dates: List[str]) -> List[Tuple[str, str]]:
+        """從滾動報告與狀態中移除不再相鄰的組合，之後由 pending_pairs 重新計算"""
+        stale = self.stale_pairs(dates)
+        if not stale:
+            return []
+
+        print(f"警告：{len(stale)} 組日期比較已不再相鄰（補收集了中間的日期），重建報告中的對應資料")
+        labels = {f"{date1} to {date2}" for date1, date2 in stale}
+        if os.path.exists(self.report_file):
+            tmp_file = f"{self.report_file}.tmp"
+            with open(self.report_file, 'r', newline='', encoding='utf-8') as src, \
+                    open(tmp_file, 'w', newline='', encoding='utf-8') as dst:
+                reader = csv.DictReader(src)
+                writer = csv.DictWriter(dst, fieldnames=reader.fieldnames)
+                writer.writeheader()
+                for row in reader:
+                    if row.get(self.label_field) not in labels:
+                        writer.writerow(row)
+            os.replace(tmp_file, self.report_file)
+
+        self.pairs.difference_update(stale)
+        self.save()
+        return stale
+
+    def mark_done(self, pairs: List[Tuple[str, str]]) -> None:
+        """標記組合已輸出並寫回狀態檔"""
+        self.pairs.update(pairs)
+        self.save()
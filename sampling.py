@@ -0,0 +1,63 @@
+import hashlib
+import math
+from typing import Dict, Iterable, Optional, Tuple
+
+SAMPLE_UNITS = ("day", "device")
+
+
+class Sampler:
+    """以雜湊值決定的抽樣器，同一組設定在收集器與分析器之間結果一致
+
+    unit="day" 時整天抽樣（該天所有設備都查詢），unit="device" 時依設備抽樣
+    （被抽中的設備每天都查詢，適合趨勢比較）。
+    """
+    def __init__(self, probability: float, unit: str = "day", seed: str = "milix"):
+        if not 0 < probability <= 1:
+            raise ValueError(f"抽樣機率必須介於 0 與 1 之間: {probability}")
+        if unit not in SAMPLE_UNITS:
+            raise ValueError(f"未知的抽樣單位: {unit}")
+        self.probability = probability
+        self.unit = unit
+        self.seed = seed
+
+    def keep(self, date: str, ip: str) -> bool:
+        """判斷 (日期, 設備) 是否被抽中"""
+        if self.probability >= 1:
+            return True
+        key = date if self.unit == "day" else ip
+        digest = hashlib.sha1(f"{self.seed}:{self.unit}:{key}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64 < self.probability
+
+    def metadata(self) -> dict:
+        """寫入收集結果的抽樣資訊"""
+        return {"sample_probability": self.probability, "sample_unit": self.unit}
+
+
+def inclusion_probability(metadata: Optional[Dict]) -> Tuple[float, Optional[str]]:
+    """讀取收集結果 metadata 中的抽樣設定，回傳 (抽樣機率, 抽樣單位)
+
+    未記錄抽樣資訊的檔案（啟用抽樣前收集的資料或彙總資料）視為完整收集，機率為 1。
+    """
+    probability = (metadata or {}).get('sample_probability', 1.0)
+    if probability >= 1:
+        return 1.0, None
+    return probability, (metadata or {}).get('sample_unit', "day")
+
+
+def ht_terms(value: float, probability: float) -> Tuple[float, float]:
+    """單一抽樣單位對 Horvitz-Thompson 估計的貢獻，回傳 (估計總數, 變異數)
+
+    各單位的估計總數與變異數分別加總即為母體總數的估計與其變異數。
+    """
+    return value / probability, (1 - probability) / (probability * probability) * value * value
+
+
+def estimate_totals(units: Iterable[Tuple[float, float]]) -> Tuple[float, float]:
+    """由各抽樣單位的 (觀測值, 抽樣機率) 估計母體總數與標準誤差"""
+    estimate = 0.0
+    variance = 0.0
+    for value, probability in units:
+        unit_estimate, unit_variance = ht_terms(value, probability)
+        estimate += unit_estimate
+        variance += unit_variance
+    return estimate, math.sqrt(variance)
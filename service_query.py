@@ -0,0 +1,341 @@
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+import fast_json
+from compactor_retention import list_periods, period_bounds
+from site_shard import device_label
+
+
+class LRUCache:
+    """固定容量的 LRU 快取，每次清除時遞增 generation"""
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """取得快取值，不存在時回傳 None"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value, generation: Optional[int] = None) -> None:
+        """寫入快取，超過容量時移除最久未使用的項目
+
+        傳入 generation 時，若快取在計算期間已被清除則不寫入，避免放回過期的結果。
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """清除所有快取"""
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+class ResultIndex:
+    """將收集結果載入記憶體，依設備、日期與目的地建立索引"""
+    def __init__(self, elastic_dir: str = "elastic_query_results",
+                 dns_dir: str = "dns_query_results"):
+        self.elastic_dir = elastic_dir
+        self.dns_dir = dns_dir
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self) -> None:
+        """清空索引"""
+        # traffic[device][label] = {目的 IP: 連線次數}
+        self.traffic: Dict[str, Dict[str, Dict[str, int]]] = defaultdict(dict)
+        # names[device][label] = {回應 IP: {查詢名稱}}
+        self.names: Dict[str, Dict[str, Dict[str, set]]] = defaultdict(dict)
+        # domains[查詢名稱] = {(device, label)}
+        self.domains: Dict[str, set] = defaultdict(set)
+        self.bounds: Dict[str, Tuple[date, date]] = {}
+        # 已載入期間的目錄修改時間 (流量, DNS)
+        self.loaded: Tuple[Dict[str, int], Dict[str, int]] = ({}, {})
+
+    def refresh(self) -> bool:
+        """載入新出現或有新增檔案的日期/彙總期間，有變更時回傳 True"""
+        elastic_periods = self.snapshot_periods(self.elastic_dir)
+        dns_periods = self.snapshot_periods(self.dns_dir)
+        with self.lock:
+            loaded_elastic, loaded_dns = self.loaded
+            if (loaded_elastic.keys() - elastic_periods.keys()) or (loaded_dns.keys() - dns_periods.keys()):
+                # 每日資料被彙總後期間標籤會改變，重新建立整個索引
+                self.reset()
+                loaded_elastic, loaded_dns = self.loaded
+                changed = True
+            else:
+                changed = False
+
+            for label, (path, mtime) in elastic_periods.items():
+                if loaded_elastic.get(label) != mtime:
+                    self.load_traffic(label, path)
+                    loaded_elastic[label] = mtime
+                    changed = True
+            for label, (path, mtime) in dns_periods.items():
+                if loaded_dns.get(label) != mtime:
+                    self.load_dns(label, path)
+                    loaded_dns[label] = mtime
+                    changed = True
+            return changed
+
+    @staticmethod
+    def snapshot_periods(base_dir: str) -> Dict[str, Tuple[str, int]]:
+        """列出期間目錄與其修改時間，用於判斷是否有新收集的檔案"""
+        periods = {}
+        for label, path in list_periods(base_dir).items():
+            try:
+                periods[label] = (path, os.stat(path).st_mtime_ns)
+            except OSError:
+                continue
+        return periods
+
+    def load_traffic(self, label: str, path: str) -> None:
+        """載入單一期間的流量資料"""
+        self.bounds[label] = period_bounds(label)
+        for data in self.iter_json(path):
+            if 'metadata' in data and 'data' in data:
+                metadata = data['metadata']
+                device = device_label(metadata['source_ip'], metadata.get('site'))
+                self.traffic[device][label] = data['data']
+
+    def load_dns(self, label: str, path: str) -> None:
+        """載入單一期間的 DNS 資料"""
+        self.bounds[label] = period_bounds(label)
+        for data in self.iter_json(path):
+            site = data.get('metadata', {}).get('site')
+            for record in data.get('records', []):
+                question_name = record['question_name'].rstrip('.')
+                if not question_name or question_name.endswith('.in-addr.arpa'):
+                    continue
+                device = device_label(record['dst_ip'], site)
+                answers = self.names[device].setdefault(label, {})
+                for answer_ip in record['answer_ips']:
+                    answers.setdefault(answer_ip, set()).add(question_name)
+                self.domains[question_name].add((device, label))
+
+    @staticmethod
+    def iter_json(path: str) -> Iterator[Dict]:
+        """逐一讀取目錄中的 JSON 檔案"""
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(path, filename), 'r', encoding='utf-8') as f:
+                    yield fast_json.load(f)
+            except (fast_json.JSONDecodeError, OSError) as e:
+                print(f"警告：無法讀取 {filename}: {str(e)}")
+
+    def in_range(self, label: str, start: Optional[date], end: Optional[date]) -> bool:
+        """判斷期間是否與查詢範圍重疊"""
+        period_start, period_end = self.bounds[label]
+        return (start is None or period_end >= start) and (end is None or period_start <= end)
+
+    def device_rows(self, device: str, start: Optional[date],
+                    end: Optional[date]) -> Iterator[Dict]:
+        """設備在範圍內連線的所有目的地"""
+        # 只在鎖內取得快照，串流輸出時不阻擋資料更新
+        with self.lock:
+            traffic = self.traffic.get(device, {})
+            names = self.names.get(device, {})
+            labels = [label for label in sorted(set(traffic) | set(names))
+                      if self.in_range(label, start, end)]
+            snapshot = [(label, traffic.get(label, {}), names.get(label, {})) for label in labels]
+
+        for label, counts, answers in snapshot:
+            for dst_ip in sorted(set(counts) | set(answers)):
+                yield {
+                    'date': label,
+                    'device_ip': device,
+                    'dst_ip': dst_ip,
+                    'dns_names': sorted(answers.get(dst_ip, ())),
+                    'count': counts.get(dst_ip, 0)
+                }
+
+    def domain_rows(self, domain: str, start: Optional[date],
+                    end: Optional[date]) -> Iterator[Dict]:
+        """範圍內查詢過指定網域的設備與其連線次數"""
+        domain = domain.rstrip('.')
+        with self.lock:
+            snapshot = [(device, label, self.traffic.get(device, {}).get(label, {}),
+                         self.names.get(device, {}).get(label, {}))
+                        for device, label in sorted(self.domains.get(domain, ()))
+                        if self.in_range(label, start, end)]
+
+        for device, label, counts, answers in snapshot:
+            for answer_ip, names in sorted(answers.items()):
+                if domain in names:
+                    yield {
+                        'date': label,
+                        'device_ip': device,
+                        'dns_name': domain,
+                        'dst_ip': answer_ip,
+                        'count': counts.get(answer_ip, 0)
+                    }
+
+    def range_rows(self, start: Optional[date], end: Optional[date]) -> Iterator[Dict]:
+        """範圍內所有設備的連線紀錄"""
+        with self.lock:
+            devices = sorted(set(self.traffic) | set(self.names))
+        for device in devices:
+            yield from self.device_rows(device, start, end)
+
+
+class QueryService:
+    """以 LRU 快取包裝 ResultIndex，新資料收集後自動失效"""
+    def __init__(self, index: ResultIndex, cache_size: int = 256,
+                 max_cached_rows: int = 10000, refresh_interval: float = 60.0):
+        """
+        Args:
+            index: 收集結果索引
+            cache_size: 快取的查詢數量
+            max_cached_rows: 超過此筆數的結果不快取，直接串流回傳
+            refresh_interval: 檢查新收集資料的最短間隔（秒）
+        """
+        self.index = index
+        self.cache = LRUCache(cache_size)
+        self.max_cached_rows = max_cached_rows
+        self.refresh_interval = refresh_interval
+        self.last_refresh = 0.0
+        self.refresh_lock = threading.Lock()
+        self.maybe_refresh(force=True)
+
+    def maybe_refresh(self, force: bool = False) -> None:
+        """定期檢查新資料，有變更時清除快取"""
+        with self.refresh_lock:
+            if not force and time.monotonic() - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = time.monotonic()
+            if self.index.refresh():
+                self.cache.clear()
+
+    def query(self, kind: str, key: Optional[str], start: Optional[date],
+              end: Optional[date]) -> Iterator[Dict]:
+        """執行查詢，命中快取時直接回傳快取結果"""
+        self.maybe_refresh()
+        cache_key = (kind, key, start, end)
+        # 在查詢開始時記錄 generation，串流期間資料更新時不寫入快取
+        generation = self.cache.generation
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return iter(cached)
+
+        if kind == "device":
+            rows = self.index.device_rows(key, start, end)
+        elif kind == "domain":
+            rows = self.index.domain_rows(key, start, end)
+        else:
+            rows = self.index.range_rows(start, end)
+        return self.cache_rows(cache_key, rows, generation)
+
+    def cache_rows(self, cache_key: Tuple, rows: Iterator[Dict],
+                   generation: int) -> Iterator[Dict]:
+        """邊輸出邊暫存結果，筆數在上限內時寫入快取"""
+        buffered: Optional[List[Dict]] = []
+        for row in rows:
+            if buffered is not None:
+                buffered.append(row)
+                if len(buffered) > self.max_cached_rows:
+                    buffered = None
+            yield row
+        if buffered is not None:
+            self.cache.put(cache_key, buffered, generation)
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """HTTP 端點：
+
+    GET /devices/<ip>?start=YYYY-MM-DD&end=YYYY-MM-DD
+    GET /devices/<site>/<ip>?start=...&end=...（多站點合併後的設備）
+    GET /domains/<name>?start=...&end=...
+    GET /range?start=...&end=...
+
+    回應為以 chunked 編碼串流的 NDJSON（每行一筆 JSON）。
+    """
+    protocol_version = "HTTP/1.1"
+    service: QueryService = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        params = parse_qs(url.query)
+
+        try:
+            start = self.parse_date(params.get('start', [None])[0])
+            end = self.parse_date(params.get('end', [None])[0])
+        except ValueError:
+            self.send_error_json(400, "日期格式必須為 YYYY-MM-DD")
+            return
+
+        if len(parts) in (2, 3) and parts[0] == "devices":
+            rows = self.service.query("device", "/".join(parts[1:]), start, end)
+        elif len(parts) == 2 and parts[0] == "domains":
+            rows = self.service.query("domain", parts[1], start, end)
+        elif parts == ["range"]:
+            rows = self.service.query("range", None, start, end)
+        else:
+            self.send_error_json(404, "未知的查詢路徑")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for row in rows:
+            self.write_chunk((fast_json.dumps(row) + "\n").encode('utf-8'))
+        self.write_chunk(b"")
+
+    @staticmethod
+    def parse_date(value: Optional[str]) -> Optional[date]:
+        """解析查詢參數中的日期"""
+        return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+    def write_chunk(self, data: bytes) -> None:
+        """寫出一個 chunked 區塊，空資料代表結束"""
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+
+    def send_error_json(self, status: int, message: str) -> None:
+        """回傳 JSON 格式的錯誤訊息"""
+        body = fast_json.dumps({'error': message}).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    # 固定配置
+    HOST = "127.0.0.1"
+    PORT = 8080
+
+    print("載入收集結果...")
+    QueryRequestHandler.service = QueryService(ResultIndex())
+    server = ThreadingHTTPServer((HOST, PORT), QueryRequestHandler)
+    print(f"查詢服務已啟動：http://{HOST}:{PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n查詢服務已停止")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import sys
+from typing import Dict
+
+import requests
+import urllib3
+from requests.auth import HTTPBasicAuth
+
+import fast_json
+
+# 禁用 SSL 警告
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# 每日彙總索引，收集器以 summary_index 參數指定
+SESSIONS_SUMMARY_INDEX = "milix-sessions-daily"
+DNS_SUMMARY_INDEX = "milix-dns-daily"
+
+
+class TransformProvisioner:
+    """建立持續執行的 Elasticsearch transform，將原始資料預先彙總為每日摘要索引"""
+    def __init__(self, host: str, username: str, password: str,
+                 frequency: str = "1h", sync_delay: str = "5m"):
+        """
+        Args:
+            host: Elasticsearch 位址
+            username: 帳號
+            password: 密碼
+            frequency: transform 檢查新資料的間隔
+            sync_delay: 等待延遲寫入資料的時間
+        """
+        self.host = host
+        self.auth = HTTPBasicAuth(username, password)
+        self.headers = {"Content-Type": "application/json"}
+        self.frequency = frequency
+        self.sync_delay = sync_delay
+
+    def build_sessions_transform(self) -> Dict:
+        """Arkime sessions -> (day, source.ip, destination.ip, count)"""
+        return {
+            "description": "Milix daily session counts per source/destination IP",
+            "source": {"index": ["arkime_sessions3*"]},
+            "dest": {"index": SESSIONS_SUMMARY_INDEX},
+            "frequency": self.frequency,
+            "sync": {"time": {"field": "@timestamp", "delay": self.sync_delay}},
+            "pivot": {
+                "group_by": {
+                    "day": {"date_histogram": {"field": "@timestamp", "calendar_interval": "1d"}},
+                    "source.ip": {"terms": {"field": "source.ip"}},
+                    "destination.ip": {"terms": {"field": "destination.ip"}}
+                },
+                "aggregations": {
+                    "count": {"value_count": {"field": "@timestamp"}}
+                }
+            }
+        }
+
+    def build_dns_transform(self) -> Dict:
+        """dnsmonster -> (day, DstIP, question, answer, count)"""
+        return {
+            "description": "Milix daily DNS answers per device",
+            "source": {"index": ["pi-dnsmonster*"]},
+            "dest": {"index": DNS_SUMMARY_INDEX},
+            "frequency": self.frequency,
+            "sync": {"time": {"field": "Timestamp", "delay": self.sync_delay}},
+            "pivot": {
+                "group_by": {
+                    "day": {"date_histogram": {"field": "Timestamp", "calendar_interval": "1d"}},
+                    "DstIP": {"terms": {"field": "DstIP.keyword"}},
+                    "question": {"terms": {"field": "DNS.Question.Name.keyword"}},
+                    # 沒有 A 紀錄的回應仍保留，answer 為 null
+                    "answer": {"terms": {"field": "DNS.Answer.A.keyword", "missing_bucket": True}}
+                },
+                "aggregations": {
+                    "count": {"value_count": {"field": "Timestamp"}}
+                }
+            }
+        }
+
+    def put_transform(self, transform_id: str, body: Dict) -> bool:
+        """建立 transform，已存在時視為成功"""
+        try:
+            response = requests.put(
+                f"{self.host}/_transform/{transform_id}",
+                auth=self.auth,
+                headers=self.headers,
+                data=fast_json.dumps(body),
+                verify=False,
+                timeout=30
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"建立 transform {transform_id} 時發生錯誤：{e}")
+            return False
+
+        if response.status_code == 200:
+            print(f"已建立 transform {transform_id}")
+            return True
+        if response.status_code == 409:
+            print(f"transform {transform_id} 已存在")
+            return True
+        print(f"建立 transform {transform_id} 失敗，狀態碼：{response.status_code}")
+        print(f"回應內容：{response.text}")
+        return False
+
+    def start_transform(self, transform_id: str) -> bool:
+        """啟動 transform，已在執行中時視為成功"""
+        try:
+            response = requests.post(
+                f"{self.host}/_transform/{transform_id}/_start",
+                auth=self.auth,
+                headers=self.headers,
+                verify=False,
+                timeout=30
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"啟動 transform {transform_id} 時發生錯誤：{e}")
+            return False
+
+        if response.status_code == 200:
+            print(f"已啟動 transform {transform_id}")
+            return True
+        if response.status_code == 409:
+            print(f"transform {transform_id} 已在執行中")
+            return True
+        print(f"啟動 transform {transform_id} 失敗，狀態碼：{response.status_code}")
+        print(f"回應內容：{response.text}")
+        return False
+
+    def setup(self) -> bool:
+        """建立並啟動流量與 DNS 兩個 transform"""
+        transforms = {
+            SESSIONS_SUMMARY_INDEX: self.build_sessions_transform(),
+            DNS_SUMMARY_INDEX: self.build_dns_transform()
+        }
+        success = True
+        for transform_id, body in transforms.items():
+            success = (self.put_transform(transform_id, body)
+                       and self.start_transform(transform_id)) and success
+        return success
+
+
+def main():
+    # 固定配置
+    ELASTICSEARCH_HOST = "https://127.0.0.1:9200"
+    USERNAME = "elastic"
+    PASSWORD = "password"
+
+    provisioner = TransformProvisioner(ELASTICSEARCH_HOST, USERNAME, PASSWORD)
+    if not provisioner.setup():
+        sys.exit(1)
+    print("transform 設定完成")
+
+
+if __name__ == "__main__":
+    main()
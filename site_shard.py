@@ -0,0 +1,139 @@
+import filecmp
+import ipaddress
+import os
+import shutil
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# 各站點分片資料存放的子目錄名稱
+SITES_DIR = "sites"
+# 合併後檔名中站點與設備 IP 的分隔字串，例如 <date>/taipei__192.168.1.10.json
+SITE_SEPARATOR = "__"
+
+
+def is_date_dir(name: str) -> bool:
+    """判斷目錄名稱是否為 YYYY-MM-DD 日期格式"""
+    try:
+        datetime.strptime(name, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
+
+
+def split_device_stem(stem: str) -> Tuple[Optional[str], str]:
+    """將收集結果檔名（不含副檔名）拆為 (站點, 設備 IP)，未合併的檔案站點為 None"""
+    site, separator, ip = stem.rpartition(SITE_SEPARATOR)
+    return (site, ip) if separator else (None, stem)
+
+
+def device_label(ip: str, site: Optional[str] = None) -> str:
+    """分析報告中的設備名稱，不同站點可能使用相同的私有 IP，因此加上站點"""
+    return f"{site}/{ip}" if site else ip
+
+
+class SiteShard:
+    """描述單一探針負責的站點與設備範圍"""
+    def __init__(self, site: str, shard_index: int = 0, shard_count: int = 1):
+        if not site or os.sep in site or SITE_SEPARATOR in site:
+            raise ValueError(f"無效的站點名稱: {site!r}")
+        if shard_count < 1 or not 0 <= shard_index < shard_count:
+            raise ValueError(f"無效的分片設定: {shard_index}/{shard_count}")
+        self.site = site
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+    @classmethod
+    def from_env(cls) -> Optional["SiteShard"]:
+        """從環境變數 MILIX_SITE / MILIX_SHARD_INDEX / MILIX_SHARD_COUNT 建立分片設定"""
+        site = os.environ.get("MILIX_SITE", "").strip()
+        if not site:
+            return None
+        return cls(
+            site,
+            int(os.environ.get("MILIX_SHARD_INDEX", "0")),
+            int(os.environ.get("MILIX_SHARD_COUNT", "1"))
+        )
+
+    def select(self, ip_list: List[str]) -> List[str]:
+        """依 IP 數值排序後切成連續區段，回傳本分片負責的設備"""
+        ordered = sorted(set(ip_list), key=lambda ip: int(ipaddress.ip_address(ip)))
+        size, remainder = divmod(len(ordered), self.shard_count)
+        start = self.shard_index * size + min(self.shard_index, remainder)
+        end = start + size + (1 if self.shard_index < remainder else 0)
+        return ordered[start:end]
+
+    def partition_dir(self, output_dir: str) -> str:
+        """本站點的分片輸出目錄"""
+        return os.path.join(output_dir, SITES_DIR, self.site)
+
+
+def merge_site_partitions(output_dir: str) -> Dict[str, int]:
+    """將 sites/<site>/<date>/<ip>.json 合併到 <date>/<site>__<ip>.json
+
+    以硬連結（跨檔案系統時改為複製）合併，不重新解析原始檔案。檔名保留站點，
+    不同站點使用相同私有網段時不會互相覆蓋；分析器以 split_device_stem 還原站點與 IP。
+    """
+    stats = {"merged": 0, "skipped": 0, "updated": 0}
+    sites_root = os.path.join(output_dir, SITES_DIR)
+    if not os.path.isdir(sites_root):
+        print(f"找不到分片目錄：{sites_root}")
+        return stats
+
+    for site in sorted(os.listdir(sites_root)):
+        site_path = os.path.join(sites_root, site)
+        if not os.path.isdir(site_path):
+            continue
+
+        for date_dir in sorted(os.listdir(site_path)):
+            source_dir = os.path.join(site_path, date_dir)
+            if not is_date_dir(date_dir) or not os.path.isdir(source_dir):
+                continue
+
+            target_dir = os.path.join(output_dir, date_dir)
+            os.makedirs(target_dir, exist_ok=True)
+
+            for filename in os.listdir(source_dir):
+                if not filename.endswith('.json'):
+                    continue
+                source = os.path.join(source_dir, filename)
+                target = os.path.join(target_dir, f"{site}{SITE_SEPARATOR}{filename}")
+
+                if os.path.exists(target):
+                    # 跨檔案系統時為複製檔，需比對內容判斷是否相同
+                    if os.path.samefile(source, target) or filecmp.cmp(source, target, shallow=False):
+                        stats["skipped"] += 1
+                        continue
+                    # 站點重新收集後內容改變，以新結果取代
+                    stats["updated"] += 1
+                else:
+                    stats["merged"] += 1
+                link_or_copy(source, target)
+
+    print(f"合併完成：新增 {stats['merged']}，已存在 {stats['skipped']}，"
+          f"更新 {stats['updated']}")
+    return stats
+
+
+def link_or_copy(source: str, target: str) -> None:
+    """以硬連結建立目標檔，失敗時複製；先寫入暫存檔再取代，避免留下不完整的檔案"""
+    tmp_file = f"{target}.tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    try:
+        os.link(source, tmp_file)
+    except OSError:
+        shutil.copy2(source, tmp_file)
+    os.replace(tmp_file, target)
+
+
+def main():
+    # 預設合併兩個收集器的輸出目錄
+    output_dirs = sys.argv[1:] or ["elastic_query_results", "dns_query_results"]
+    for output_dir in output_dirs:
+        print(f"\n合併 {output_dir} 的站點分片")
+        merge_site_partitions(output_dir)
+
+
+if __name__ == "__main__":
+    main()